@@ -0,0 +1,50 @@
+import itertools
+
+# Minimal stand-ins for the parts of telegram.Update / Bot the handlers touch,
+# so handlers can be driven without a token or network
+
+_message_ids = itertools.count(1)
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(chat_id, text, bot=self)
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+class FakeMessage:
+    def __init__(self, chat_id, text, bot=None):
+        self.message_id = next(_message_ids)
+        self.chat_id = chat_id
+        self.text = text
+        self.photo = []
+        self.bot = bot
+        self.replies = []
+        self.documents = 0
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return FakeMessage(self.chat_id, text, bot=self.bot)
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        # Drain the upload like the real Bot would, so export costs are counted in full
+        if hasattr(document, "read"):
+            while document.read(64 * 1024):
+                pass
+        self.documents += 1
+        return FakeMessage(self.chat_id, filename, bot=self.bot)
+
+class FakeUpdate:
+    def __init__(self, user_id, text, bot=None):
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage(user_id, text, bot=bot)
+
+class FakeContext:
+    def __init__(self, bot, args=None):
+        self.bot = bot
+        self.args = args or []
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from .run import percentile
+from .synth import synthetic_message
+
+# Local stand-in for Telegram when testing webhook.py: serves a fake Bot API for the
+# workers to answer through, and POSTs synthetic updates at the receiver.
+# Start the feeder first (workers call getMe on startup), then the workers from a
+# scratch directory, since they keep their data under ./data:
+#   python -m bench.feeder --workers 4 --updates 20000 --users 2000
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:local SHARD_WORKERS=4 python /path/to/webhook.py
+# Every update gets exactly one reply, so throughput counts updates answered end to end.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Feeder", "username": "feeder_bot"}
+
+class FakeBotApi:
+    def __init__(self):
+        self.calls = Counter()
+        self.replies = 0
+        self.replied = asyncio.Event()
+        self.expected = None
+
+    def answer(self, method):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method.startswith("send"):
+            self.replies += 1
+            if self.expected is not None and self.replies >= self.expected:
+                self.replied.set()
+            return {"message_id": self.replies, "date": int(time.time()),
+                    "chat": {"id": 1, "type": "private"}, "from": BOT_USER}
+        return True
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                path = request_line.split(" ")[1]
+                length = 0
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                body = json.dumps({"ok": True, "result": self.answer(path.rsplit("/", 1)[-1])}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def synthetic_update(update_id, user_id, rng):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+    }
+    if rng.random() < 0.2:
+        message["text"] = "/summary"
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": 8}]
+    else:
+        message["text"] = synthetic_message(1, seed=update_id)
+    return {"update_id": update_id, "message": message}
+
+async def feed(args):
+    api = FakeBotApi()
+    server = await asyncio.start_server(api.handle, "127.0.0.1", args.api_port)
+    print(f"[INFO] Fake Bot API on http://127.0.0.1:{args.api_port}, waiting for {args.workers} workers",
+          file=sys.stderr)
+    while api.calls["getMe"] < args.workers:
+        await asyncio.sleep(0.1)
+    rng = random.Random(0)
+    user_ids = [3_000_000_000 + i for i in range(args.users)]
+    updates = [synthetic_update(i + 1, rng.choice(user_ids), rng) for i in range(args.updates)]
+    api.expected = api.replies + len(updates)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    latencies, statuses = [], Counter()
+    pending = iter(updates)
+
+    async with server, httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        async def sender():
+            # Like Telegram, retry a user's update until the receiver accepts it
+            for update in pending:
+                while True:
+                    t = time.perf_counter()
+                    try:
+                        res = await client.post(args.url, json=update, headers=headers)
+                    except httpx.TransportError:
+                        await asyncio.sleep(0.1)  # Receiver not listening yet
+                        continue
+                    latencies.append(time.perf_counter() - t)
+                    statuses[res.status_code] += 1
+                    if res.status_code != 503:
+                        break
+                    await asyncio.sleep(0.05)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+        fed = time.perf_counter() - started
+        try:
+            await asyncio.wait_for(api.replied.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            print(f"[WARNING] Only {api.replies} of {api.expected} replies within {args.timeout}s", file=sys.stderr)
+        answered = time.perf_counter() - started
+
+    return {
+        "updates": len(updates),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "replies": api.replies,
+        "feed_seconds": round(fed, 3),
+        "answer_seconds": round(answered, 3),
+        "throughput_per_s": round(api.replies / answered, 2),
+        "post_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "post_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "statuses": dict(statuses),
+        "api_calls": dict(api.calls),
+    }
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Feed synthetic updates to webhook.py and count the replies")
+    arg_parser.add_argument("--url", default="http://127.0.0.1:8443/webhook", help="Receiver webhook URL")
+    arg_parser.add_argument("--api-port", type=int, default=8081, help="Port for the fake Bot API")
+    arg_parser.add_argument("--workers", type=int, default=1, help="Workers to wait for before feeding")
+    arg_parser.add_argument("--updates", type=int, default=10000)
+    arg_parser.add_argument("--users", type=int, default=1000)
+    arg_parser.add_argument("--concurrency", type=int, default=64, help="Parallel webhook connections")
+    arg_parser.add_argument("--secret", help="WEBHOOK_SECRET the receiver expects")
+    arg_parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for the last reply")
+    args = arg_parser.parse_args()
+    print(json.dumps(asyncio.run(feed(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
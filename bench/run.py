@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from .synth import synthetic_user, synthetic_message
+from .fakes import FakeBot, FakeContext, FakeUpdate
+
+# Hot-path benchmarks against synthetic users in the real data/ format.
+# Run from the repo root:
+#   python -m bench.run --ledger-sizes 100,10000,1000000 --fleet-sizes 1,1000,50000 --output bench.json
+# Results are JSON so runs can be diffed over time.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_sizes(text):
+    return [int(part) for part in text.split(",") if part]
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    def record(self, name, params, latencies, wall, ops=None):
+        ops = ops or len(latencies)
+        result = {
+            "name": name,
+            "params": params,
+            "ops": ops,
+            "seconds": round(wall, 6),
+            "throughput_per_s": round(ops / wall, 2) if wall else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "peak_rss_kb": peak_rss_kb(),
+        }
+        self.results.append(result)
+        print(f"{name:<32} {json.dumps(params):<28} p50={result['p50_ms']}ms p99={result['p99_ms']}ms",
+              file=sys.stderr)
+
+    def run(self, name, params, func, iterations, setup=None):
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            if setup:
+                setup()
+            t = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - t)
+        self.record(name, params, latencies, time.perf_counter() - started)
+
+    async def arun(self, name, params, make_coro, iterations, setup=None):
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            if setup:
+                setup()
+            t = time.perf_counter()
+            await make_coro()
+            latencies.append(time.perf_counter() - t)
+        self.record(name, params, latencies, time.perf_counter() - started)
+
+def iterations_for(size, requested):
+    # Keep 1M-expense runs to a handful of iterations
+    return max(3, min(requested, 2_000_000 // max(size, 1)))
+
+async def bench_ledger(rec, size, requested, storage, bot):
+    user_id = 10_000_000 + size
+    params = {"expenses": size}
+    iterations = iterations_for(size, requested)
+    document = synthetic_user(size, seed=size)
+    fake_bot = FakeBot()
+
+    def save():
+        storage.save_user_data(user_id, document)
+        storage.flush()
+
+    rec.run("storage.save_user_data", params, save, iterations)
+    rec.run("storage.get_user_data.cold", params, lambda: storage.get_user_data(user_id),
+            iterations, setup=storage.clear_cache)
+    rec.run("storage.get_user_data.hot", params, lambda: storage.get_user_data(user_id), requested)
+    this_month = [datetime.now().strftime("%Y-%m")]
+    rec.run("storage.get_profile.month.cold", params, lambda: storage.get_profile(user_id, this_month),
+            iterations, setup=storage.clear_cache)
+
+    await rec.arun("main.add_expense", params,
+                   lambda: bot.add_expense(FakeUpdate(user_id, "coffee 4 refill", fake_bot), FakeContext(fake_bot)),
+                   requested)
+    for args in ([], ["month"]):
+        await rec.arun("main.summary", {**params, "args": args},
+                       lambda: bot.summary(FakeUpdate(user_id, "/summary", fake_bot), FakeContext(fake_bot, args)),
+                       requested)
+    await rec.arun("main.export_csv", params,
+                   lambda: bot.export_csv(FakeUpdate(user_id, "/export", fake_bot), FakeContext(fake_bot)),
+                   iterations)
+    await rec.arun("main.export_csv.cold", params,
+                   lambda: bot.export_csv(FakeUpdate(user_id, "/export", fake_bot), FakeContext(fake_bot)),
+                   iterations, setup=storage.clear_cache)
+
+    from utils import rollups
+    from utils.ledger import Ledger
+
+    expenses = document["expenses"]
+    rec.run("ledger.from_expenses", params, lambda: Ledger.from_expenses(expenses), iterations)
+    columns = Ledger.from_expenses(expenses)
+    rec.results[-1]["bytes_per_expense"] = round(columns.nbytes / max(len(columns), 1), 1)
+    rec.run("ledger.by_category", params, columns.by_category, requested)
+    rec.run("ledger.by_month", params, columns.by_month, requested)
+    # The dict-based monthly rollups built from the same expenses, for comparison
+    rec.run("rollups.build", params, lambda: rollups.build(expenses), iterations)
+
+async def bench_fleet(rec, users, storage, scheduler):
+    user_ids = [str(2_000_000_000 + i) for i in range(users)]
+    for i, user_id in enumerate(user_ids):
+        storage.save_user_data(user_id, synthetic_user(20, seed=i))
+    storage.clear_cache()
+    fake_bot = FakeBot()
+    for job in (scheduler.send_daily_summary,):
+        latencies = []
+
+        @functools.wraps(job)
+        async def timed(bot, user_id, chat_id, job=job):
+            t = time.perf_counter()
+            await job(bot, user_id, chat_id)
+            latencies.append(time.perf_counter() - t)
+
+        started = time.perf_counter()
+        await scheduler.fan_out(fake_bot, timed, user_ids)
+        rec.record(f"scheduler.fan_out.{job.__name__}", {"users": users},
+                   latencies, time.perf_counter() - started, ops=users)
+
+# (format, compression, binary token): the first is how every payload was stored before utils/codec.py
+CODEC_VARIANTS = [("json", "none", False), ("msgpack", "none", True), ("msgpack", "zlib", True), ("msgpack", "zstd", True)]
+
+def bench_codec(rec, size, requested):
+    from cryptography.fernet import Fernet
+    from utils import backends, codec
+
+    document = synthetic_user(size, seed=size)
+    fernet = Fernet(Fernet.generate_key())
+    iterations = iterations_for(size, requested)
+    saved = codec.PAYLOAD_FORMAT, codec.PAYLOAD_COMPRESSION
+    try:
+        for payload_format, compression, binary in CODEC_VARIANTS:
+            if compression == "zstd" and not codec.ZSTD_AVAILABLE:
+                continue
+            codec.PAYLOAD_FORMAT, codec.PAYLOAD_COMPRESSION = payload_format, compression
+            params = {"expenses": size, "format": payload_format, "compression": compression}
+            token = backends.encode_payload(fernet, document, binary)
+            rec.run("codec.encode", params, lambda: backends.encode_payload(fernet, document, binary), iterations)
+            rec.results[-1]["bytes"] = len(token)
+            rec.run("codec.decode", params, lambda: backends.decode_payload(fernet, token), iterations)
+    finally:
+        codec.PAYLOAD_FORMAT, codec.PAYLOAD_COMPRESSION = saved
+
+def bench_parser(rec, requested, parser):
+    single = "spent 50 on food at the cafe"
+    batch = synthetic_message(20)
+    rec.run("parser.parse_expense_message", {"lines": 1}, lambda: parser.parse_expense_message(single), requested * 10)
+    rec.run("parser.parse_expenses", {"lines": 20}, lambda: parser.parse_expenses(batch), requested * 10)
+
+async def run_all(args, storage, parser, scheduler, bot):
+    rec = Recorder()
+    bench_parser(rec, args.iterations, parser)
+    for size in parse_sizes(args.ledger_sizes):
+        bench_codec(rec, size, args.iterations)
+        await bench_ledger(rec, size, args.iterations, storage, bot)
+    for users in parse_sizes(args.fleet_sizes):
+        await bench_fleet(rec, users, storage, scheduler)
+    return rec.results
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the bot's hot paths")
+    arg_parser.add_argument("--ledger-sizes", default="100,10000", help="Expenses per user, comma-separated")
+    arg_parser.add_argument("--fleet-sizes", default="1,1000", help="Users for the scheduler fan-out")
+    arg_parser.add_argument("--iterations", type=int, default=50)
+    arg_parser.add_argument("--data-dir", help="Working directory for synthetic data (default: a temp dir)")
+    arg_parser.add_argument("--keep", action="store_true", help="Keep the synthetic data afterwards")
+    arg_parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = arg_parser.parse_args()
+
+    workdir = os.path.abspath(args.data_dir or tempfile.mkdtemp(prefix="expense-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    # Flushes are driven by the benchmarks, and the fake bot has no flood limit
+    os.environ.setdefault("STORAGE_FLUSH_INTERVAL", "3600")
+    os.environ.setdefault("SCHEDULER_SEND_RATE", "1000000")
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)  # storage keeps everything under ./data
+
+    from utils import storage, parser, scheduler
+    import main as bot
+
+    try:
+        # Keep stdout clean for the JSON report
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(run_all(args, storage, parser, scheduler, bot))
+    finally:
+        storage.shutdown()
+        if not args.data_dir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": storage.STORAGE_BACKEND,
+            "args": vars(args),
+        },
+        "results": results,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
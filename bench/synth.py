@@ -0,0 +1,39 @@
+import random
+from datetime import datetime, timedelta
+
+CATEGORIES = ["food", "coffee", "taxi", "rent", "groceries", "fun", "health", "travel", "bills", "misc"]
+WORDS = ["lunch", "with", "team", "airport", "weekly", "shop", "gift", "online", "refill", "ticket"]
+
+def synthetic_expenses(count, seed=0, end=None):
+    # Spread evenly over the days before `end`, a handful per day
+    rng = random.Random(seed)
+    end = end or datetime.now()
+    start = end - timedelta(days=max(1, count // 5))
+    span = (end - start).total_seconds()
+    expenses = []
+    for i in range(count):
+        stamp = start + timedelta(seconds=span * i / max(1, count))
+        expense = {
+            "amount": round(rng.uniform(1, 200), 2),
+            "category": rng.choice(CATEGORIES),
+            "date": stamp.isoformat(),
+        }
+        if rng.random() < 0.3:
+            expense["description"] = " ".join(rng.sample(WORDS, 2))
+        expenses.append(expense)
+    return expenses
+
+def synthetic_user(expense_count, seed=0):
+    return {
+        "expenses": synthetic_expenses(expense_count, seed),
+        "budget": 2000,
+        "currency": "USD",
+        "category_limits": {"food": 500, "taxi": 200},
+        "email": None,
+    }
+
+def synthetic_message(lines, seed=0):
+    rng = random.Random(seed)
+    return "\n".join(
+        f"{rng.choice(CATEGORIES)} {rng.randint(1, 300)} {rng.choice(WORDS)}" for _ in range(lines)
+    )
@@ -1,41 +1,52 @@
 import logging
 import os
 import re
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup
 )
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
-    filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+    ApplicationBuilder, CommandHandler, MessageHandler, TypeHandler,
+    filters, ContextTypes, ConversationHandler, CallbackQueryHandler, ApplicationHandlerStop
 )
 
-from utils import storage, parser
-from utils.scheduler import schedule_jobs
+from utils import storage, parser, rollups, export, currency, mailer, instrumentation, receipts, recurring, alerts, charts, importer, auth, downloads
+from utils.persistence import SessionPersistence
+from utils.updates import PerUserUpdateProcessor
+from utils.scheduler import schedule_jobs, post_recurring_now
 
 logging.basicConfig(level=logging.INFO)
+# httpx logs every Bot API request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Conversation states
-ASK_PIN, VERIFY_PIN, ADD_EXPENSE, ADD_RECUR, SET_LIMIT, SET_BUDGET, SET_EMAIL, ASK_CURRENCY, ASK_EMAIL = range(9)
+ASK_PIN, VERIFY_PIN, ADD_EXPENSE, ADD_RECUR, SET_LIMIT, SET_BUDGET, SET_EMAIL, ASK_CURRENCY, ASK_EMAIL, IMPORT_FILE = range(10)
+
+# Seconds between progress edits while an import runs
+IMPORT_PROGRESS_INTERVAL = 2
+
+def default_settings():
+    return {"budget": 0, "currency": "USD", "category_limits": {}, "email": None}
 
 # -------------------- START / PIN --------------------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    # Initialize new user
-    if not storage.get_user_data(user_id):
-        storage.save_user_data(user_id, {
-            "expenses": [],
-            "budget": 0,
-            "currency": "USD",
-            "pin": None,
-            "category_limits": {},
-            "email": None,
-        })
-
+    # New means no settings yet: expenses logged before /start already make the
+    # user known to the manifest (and give them an empty profile)
+    async with storage.user_lock(user_id):
+        profile = await storage.aget_profile(user_id, months=()) or {}
+        is_new = "currency" not in profile
+        if is_new:
+            for key, value in default_settings().items():
+                profile.setdefault(key, value)
+            await storage.asave_profile(user_id, profile)
+
+    if is_new:
         await update.message.reply_text(
             "👋 Welcome to *Expense Tracker Bot*! 🧾💸\n\n"
             "This bot helps you securely track expenses:\n"
@@ -50,15 +61,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/limit - Category limit\n"
             "/setbudget - Monthly budget\n"
             "/setemail - Save email\n"
-            "/summary - Today’s summary\n"
-            "/upload - Upload receipt\n"
-            "/export - Export CSV\n"
+            "/summary - Today’s summary (or /summary week, /summary month, optional currency e.g. EUR)\n"
+            "/upload - Upload receipt (caption it to pick or add the expense)\n"
+            "/export - Export CSV (optional: start end category gz)\n"
+            "/chart - Spending chart (week, month or year)\n"
+            "/import - Import a CSV (an /export file or a bank statement)\n"
             "/settings - Manage PIN, currency, preferences\n\n"
             "🔐 Set a 4-digit PIN to protect your data:",
             parse_mode="Markdown"
         )
         return ASK_PIN
 
+    if auth.is_verified(user_id):
+        await update.message.reply_text("👋 Welcome back! Use /add to log expenses.")
+        return ConversationHandler.END
+    if not await auth.ahas_pin(user_id):
+        await update.message.reply_text("👋 Welcome back! 🔐 Set a 4-digit PIN to protect your data:")
+        return ASK_PIN
+    context.user_data["awaiting_pin"] = True
     await update.message.reply_text(
         "👋 Welcome back! 🔐\n\n"
         "Please enter your 4-digit PIN to access your data.",
@@ -71,50 +91,90 @@ async def ask_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not pin.isdigit() or len(pin) != 4:
         await update.message.reply_text("PIN must be 4 digits. Try again:")
         return ASK_PIN
-    storage.set_user_pin(update.effective_user.id, pin)
+    await auth.aset_pin(update.effective_user.id, pin)
     await update.message.reply_text("✅ PIN set! Start tracking expenses.")
     return ConversationHandler.END
 
 async def verify_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pin = update.message.text.strip()
-    if storage.validate_user_pin(update.effective_user.id, pin):
+    ok, locked_for = await auth.averify_pin(update.effective_user.id, pin)
+    if ok:
+        context.user_data.pop("awaiting_pin", None)
         await update.message.reply_text("🔓 Access granted! Use /add to log expenses.")
         return ConversationHandler.END
+    if locked_for:
+        await update.message.reply_text(f"⛔ Too many wrong PINs. Try again in {int(locked_for // 60) + 1} min:")
+        return VERIFY_PIN
     await update.message.reply_text("❌ Incorrect PIN. Try again:")
     return VERIFY_PIN
 
+async def auth_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every other handler. Once verified this is one dict lookup;
+    # users who never set a PIN aren't gated
+    user = update.effective_user
+    if user is None or auth.is_verified(user.id):
+        return
+    message = update.effective_message
+    text = (message.text or "") if message else ""
+    if text.split("@")[0].split()[:1] == ["/start"]:
+        return
+    if context.user_data.get("awaiting_pin") and text and not text.startswith("/"):
+        return  # The PIN itself
+    if not await auth.ahas_pin(user.id):
+        return
+    if update.callback_query:
+        await update.callback_query.answer()
+    if message:
+        await message.reply_text("🔒 Send /start and enter your PIN to continue.")
+    raise ApplicationHandlerStop
+
 # -------------------- EXPENSES --------------------
 
+async def store_expenses(user_id, expenses):
+    # One storage write for the batch, then the budget and limit alerts it set off
+    async with storage.user_lock(user_id):
+        await storage.aappend_expenses(user_id, expenses)
+        return await alerts.check(user_id, expenses)
+
 async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    parsed = parser.parse_expense_message(update.message.text)
-    if not parsed:
+    expenses = parser.parse_expenses(update.message.text)
+    if not expenses:
         await update.message.reply_text("Couldn't understand. Try 'Spent 50 on food'")
         return
     user_id = update.effective_user.id
-    user_data = storage.get_user_data(user_id)
-    expenses = user_data.get("expenses", [])
-    parsed["date"] = datetime.now().isoformat()
-    expenses.append(parsed)
-    user_data["expenses"] = expenses
-    storage.save_user_data(user_id, user_data)
-    await update.message.reply_text(f"💰 Added {parsed['amount']} for {parsed['category']}")
+    now = datetime.now().isoformat()
+    for e in expenses:
+        e.setdefault("date", now)
+    # Every line of the message is committed in a single storage write
+    warnings = await store_expenses(user_id, expenses)
+    if len(expenses) == 1:
+        await update.message.reply_text(f"💰 Added {expenses[0]['amount']} for {expenses[0]['category']}")
+    else:
+        lines = [f"💰 Added {len(expenses)} expenses:"]
+        lines += [f"• {e['amount']} for {e['category']}" for e in expenses]
+        await update.message.reply_text("\n".join(lines))
+    if warnings:
+        await update.message.reply_text("\n".join(warnings))
 
 async def set_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Send recurring expense like: 'Netflix 100'")
+    await update.message.reply_text(
+        "Send recurring expense like: 'Netflix 100' (monthly from today), "
+        "'rent 800 monthly on the 1st', 'gym 30 weekly on mon' or 'coffee 3 daily'"
+    )
     return ADD_RECUR
 
 async def save_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    parsed = parser.parse_expense_message(update.message.text)
-    if not parsed:
+    rule = recurring.parse_rule(update.message.text)
+    if not rule:
         await update.message.reply_text("Couldn’t parse. Try again.")
         return
-    user_id = update.effective_user.id
-    user_data = storage.get_user_data(user_id)
-    rec = user_data.get("recurring", [])
-    rec.append(parsed)
-    user_data["recurring"] = rec
-    storage.save_user_data(user_id, user_data)
-    await update.message.reply_text("✅ Recurring expense saved.")
+    await recurring.add_rule(update.effective_user.id, rule)
+    if rule["next_due"] <= datetime.now().date().isoformat():
+        post_recurring_now(context.job_queue)
+    await update.message.reply_text(
+        f"✅ Recurring expense saved: {rule['amount']} for {rule['category']}, "
+        f"{recurring.describe(rule['schedule'])} (next on {rule['next_due']})."
+    )
     return ConversationHandler.END
 
 async def set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -129,12 +189,14 @@ async def save_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Format: category amount (e.g., food 500)")
         return
     user_id = update.effective_user.id
-    data = storage.get_user_data(user_id)
-    limits = data.get("category_limits", {})
-    limits[cat.lower()] = amt
-    data["category_limits"] = limits
-    storage.save_user_data(user_id, data)
-    await update.message.reply_text(f"✅ Limit set: {cat} → {amt} {data['currency']}")
+    async with storage.user_lock(user_id):
+        data = await storage.aget_profile(user_id, months=()) or {}
+        limits = data.get("category_limits", {})
+        limits[cat.lower()] = amt
+        data["category_limits"] = limits
+        alerts.reset(data, cat.lower())
+        await storage.asave_profile(user_id, data)
+    await update.message.reply_text(f"✅ Limit set: {cat} → {amt} {data.get('currency', 'USD')}")
     return ConversationHandler.END
 
 async def set_budget(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -148,22 +210,62 @@ async def save_budget(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid input. Please enter a number (e.g., 2000):")
         return SET_BUDGET
     user_id = update.effective_user.id
-    data = storage.get_user_data(user_id)
-    data["budget"] = budget
-    storage.save_user_data(user_id, data)
-    await update.message.reply_text(f"✅ Monthly budget set to {budget} {data['currency']}")
+    async with storage.user_lock(user_id):
+        data = await storage.aget_profile(user_id, months=()) or {}
+        data["budget"] = budget
+        alerts.reset(data)
+        await storage.asave_profile(user_id, data)
+    await update.message.reply_text(f"✅ Monthly budget set to {budget} {data.get('currency', 'USD')}")
     return ConversationHandler.END
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data = storage.get_user_data(user_id)
-    expenses = user_data.get("expenses", [])
-    if not expenses:
+    period, target = "today", None
+    for arg in context.args or []:
+        if arg.lower() in ("today", "week", "month"):
+            period = arg.lower()
+        elif re.fullmatch(r"[A-Za-z]{3}", arg):
+            target = arg.upper()
+    today = datetime.now().date()
+    week_start = today - timedelta(days=today.weekday())
+
+    # Only the months the period touches are read
+    months = rollups.months_between(week_start if period == "week" else today, today)
+    profile = await storage.aget_profile(user_id, months)
+    if not profile:
         await update.message.reply_text("No expenses recorded yet.")
         return
-    today = datetime.now().date()
-    total = sum(e['amount'] for e in expenses if datetime.fromisoformat(e['date']).date() == today)
-    await update.message.reply_text(f"📊 Today: {total} {user_data['currency']}")
+    user_currency = profile.get("currency", "USD")
+    totals = profile.get("rollups", {})
+
+    # First item is the period total, any others are per-category lines
+    if period == "week":
+        title = "This week"
+        items = [{"amount": rollups.range_total(totals, week_start, today)}]
+    elif period == "month":
+        title = "This month"
+        month = today.strftime("%Y-%m")
+        categories = rollups.month_categories(totals, month)
+        items = [{"amount": rollups.month_total(totals, month)}] + [
+            {"amount": amt, "category": cat}
+            for cat, amt in sorted(categories.items(), key=lambda item: item[1], reverse=True)
+        ]
+    else:
+        title = "Today"
+        items = [{"amount": rollups.day_total(totals, today)}]
+
+    shown_currency = user_currency
+    if target and target != user_currency:
+        try:
+            items = await currency.convert_many(items, target, default_currency=user_currency)
+        except (ValueError, RuntimeError) as e:
+            await update.message.reply_text(f"❌ Can't convert to {target}: {e}")
+            return
+        shown_currency = target
+
+    lines = [f"📊 {title}: {items[0]['amount']} {shown_currency}"]
+    lines += [f"• {item['category']}: {item['amount']}" for item in items[1:]]
+    await update.message.reply_text("\n".join(lines))
 
 # -------------------- EMAIL / EXPORT --------------------
 
@@ -177,54 +279,175 @@ async def save_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid email. Try again:")
         return
     user_id = update.effective_user.id
-    user_data = storage.get_user_data(user_id)
-    user_data["email"] = email
-    storage.save_user_data(user_id, user_data)
+    async with storage.user_lock(user_id):
+        user_data = await storage.aget_profile(user_id, months=()) or {}
+        user_data["email"] = email
+        await storage.asave_profile(user_id, user_data)
     await update.message.reply_text("📩 Email saved.")
     return ConversationHandler.END
 
 async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    import csv
-    from io import StringIO
+    try:
+        options = export.parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Format: /export [start YYYY-MM-DD] [end YYYY-MM-DD] [category] [gz]")
+        return
 
     user_id = update.effective_user.id
-    data = storage.get_user_data(user_id)
-    expenses = data.get("expenses", [])
-    if not expenses:
-        await update.message.reply_text("No expenses to export.")
+    report, count = await storage.run_blocking(
+        export.export_expenses, user_id,
+        options["start"], options["end"], options["category"], options["compress"],
+    )
+    with report:
+        if not count:
+            await update.message.reply_text("No expenses to export.")
+            return
+        await update.message.reply_document(document=report, filename=export.export_filename(**options))
+
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not charts.AVAILABLE:
+        await update.message.reply_text("📉 Charts aren't available on this server (matplotlib isn't installed).")
+        return
+    args = [arg.lower() for arg in context.args or []]
+    period = args[0] if args else "month"
+    if period not in charts.PERIODS:
+        await update.message.reply_text("Format: /chart [week|month|year]")
         return
 
-    output = StringIO()
-    writer = csv.DictWriter(output, fieldnames=["date", "amount", "category", "description"])
-    writer.writeheader()
-    for item in expenses:
-        writer.writerow(item)
+    user_id = update.effective_user.id
+    data = await storage.run_blocking(charts.chart_data, user_id, period)
+    if not data or not any(data["series"]):
+        await update.message.reply_text("No expenses to chart yet.")
+        return
+    # Unchanged data since the last /chart: re-send the photo Telegram already has
+    data_digest = charts.digest(data)
+    file_id = charts.cached_file_id(user_id, period, data_digest)
+    if file_id:
+        await update.message.reply_photo(photo=file_id)
+        return
+    png = await charts.render_png(data)
+    sent = await update.message.reply_photo(photo=png)
+    if sent and sent.photo:
+        charts.remember(user_id, period, data_digest, sent.photo[-1].file_id)
 
-    output.seek(0)
-    await update.message.reply_document(document=output.getvalue().encode(), filename="expenses.csv")
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        context.user_data["import_format"] = importer.parse_import_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(f"Format: /import [{'|'.join(importer.FORMATS)}]")
+        return ConversationHandler.END
+    await update.message.reply_text(
+        "📥 Send the CSV file now: an /export file (.csv or .csv.gz) or a bank statement."
+    )
+    return IMPORT_FILE
+
+async def receive_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    format_name = context.user_data.pop("import_format", None)
+    if (document.file_size or 0) > importer.IMPORT_MAX_BYTES:
+        await update.message.reply_text("❗ That file is too large to import.")
+        return ConversationHandler.END
+    user_id = update.effective_user.id
+    try:
+        upload = await importer.download(await document.get_file())
+    except Exception as e:
+        print(f"[ERROR] Failed to download import for user {user_id}: {e}")
+        await update.message.reply_text("❌ Couldn't download the file. Please try again.")
+        return ConversationHandler.END
+
+    job = importer.Import(user_id, upload, format_name)
+    try:
+        try:
+            await storage.run_blocking(job.open)
+        except (ValueError, *importer.READ_ERRORS) as e:
+            await update.message.reply_text(f"❌ Can't import this file: {e}\nKnown formats: {', '.join(importer.FORMATS)}")
+            return ConversationHandler.END
+        status = await update.message.reply_text(f"📥 Importing ({job.format_name})…")
+        warnings, failure = [], None
+        last_update = time.monotonic()
+        # Rows are parsed a batch at a time on the storage pool; each batch is one write
+        while True:
+            try:
+                batch = await storage.run_blocking(job.next_batch)
+            except importer.READ_ERRORS as e:
+                failure = e
+                break
+            if not batch:
+                break
+            warnings += await store_expenses(user_id, batch)
+            job.imported += len(batch)
+            if time.monotonic() - last_update >= IMPORT_PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await status.edit_text(f"📥 Importing ({job.format_name})… {job.imported} rows so far")
+    finally:
+        job.close()
+
+    lines = [f"✅ Imported {job.imported} expenses."]
+    if failure:
+        lines.append(f"⚠️ Stopped early, the rest of the file is unreadable: {failure}")
+    if job.duplicates:
+        lines.append(f"• {job.duplicates} duplicates skipped")
+    if job.skipped:
+        lines.append(f"• {job.skipped} rows skipped (credits or unreadable)")
+    lines += [f"  {error}" for error in job.errors]
+    await status.edit_text("\n".join(lines))
+    if warnings:
+        await update.message.reply_text("\n".join(warnings))
+    return ConversationHandler.END
 
 # -------------------- PHOTOS --------------------
 
 async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📸 Please send the receipt photo now.")
+    await update.message.reply_text(
+        "📸 Please send the receipt photo now.\n"
+        "It's attached to your latest expense. Caption it with a category and/or date "
+        "(e.g. 'food 2026-10-15') to pick another, or with a new expense ('lunch 12') to add one."
+    )
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not update.message.photo:
-        await update.message.reply_text("❗ No photo received.")
+    message = update.message
+    if message.photo:
+        attachment = receipts.pick_photo_size(message.photo)
+    elif message.document and (message.document.mime_type or "").startswith("image/"):
+        attachment = message.document
+    else:
+        await message.reply_text("❗ No photo received.")
+        return
+    if (attachment.file_size or 0) > receipts.RECEIPT_MAX_BYTES:
+        await message.reply_text("❗ That image is too large for a receipt.")
+        return
+    try:
+        digest = await receipts.store(await attachment.get_file())
+    except Exception as e:
+        print(f"[ERROR] Failed to store receipt for user {user_id}: {e}")
+        await message.reply_text("❌ Couldn't save the receipt. Please try again.")
         return
-    photo = update.message.photo[-1]
-    os.makedirs("receipts", exist_ok=True)
-    path = f"receipts/{user_id}_receipt.jpg"
-    file = await photo.get_file()
-    await file.download_to_drive(path)
-    await update.message.reply_text("🧾 Receipt saved.")
+
+    caption = message.caption or ""
+    expense = parser.parse_expense_message(caption)
+    if expense:
+        expense.setdefault("date", datetime.now().isoformat())
+        expense["receipt"] = digest
+        warnings = await store_expenses(user_id, [expense])
+        await message.reply_text(f"🧾 Receipt saved with a new expense: {expense['amount']} for {expense['category']}")
+        if warnings:
+            await message.reply_text("\n".join(warnings))
+        return
+    async with storage.user_lock(user_id):
+        expense = await storage.run_blocking(receipts.link, user_id, digest, caption)
+    if expense is None:
+        await message.reply_text("🧾 Receipt saved, but no matching expense was found to attach it to.")
+        return
+    await message.reply_text(
+        f"🧾 Receipt attached to {expense['amount']} for {expense['category']} on {expense['date'][:10]}."
+    )
 
 # -------------------- SETTINGS --------------------
 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    data = storage.get_user_data(user_id) or {}
+    data = await storage.aget_profile(user_id, months=()) or {}
     current_currency = data.get("currency", "USD")
 
     keyboard = [
@@ -258,23 +481,28 @@ async def received_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not pin.isdigit() or len(pin) != 4:
         await update.message.reply_text("❌ Invalid PIN. Enter 4 digits:")
         return ASK_PIN
-    user_id = update.effective_user.id
-    data = storage.get_user_data(user_id) or {}
-    data["pin"] = pin
-    storage.save_user_data(user_id, data)
+    await auth.aset_pin(update.effective_user.id, pin)
     await update.message.reply_text("✅ PIN updated.")
     return ConversationHandler.END
 
 async def received_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    currency = update.message.text.strip().upper()
-    if not re.fullmatch(r"[A-Z]{3}", currency):
+    code = update.message.text.strip().upper()
+    if not re.fullmatch(r"[A-Z]{3}", code):
         await update.message.reply_text("❌ Invalid currency. Enter a 3-letter code:")
         return ASK_CURRENCY
+    try:
+        await currency.get_rate(code)
+    except ValueError:
+        await update.message.reply_text("❌ Unknown currency. Enter a 3-letter code:")
+        return ASK_CURRENCY
+    except RuntimeError:
+        pass  # Rates unreachable right now; accept the code as typed
     user_id = update.effective_user.id
-    data = storage.get_user_data(user_id) or {}
-    data["currency"] = currency
-    storage.save_user_data(user_id, data)
-    await update.message.reply_text(f"✅ Currency updated to {currency}.")
+    async with storage.user_lock(user_id):
+        data = await storage.aget_profile(user_id, months=()) or {}
+        data["currency"] = code
+        await storage.asave_profile(user_id, data)
+    await update.message.reply_text(f"✅ Currency updated to {code}.")
     return ConversationHandler.END
 
 async def received_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -283,17 +511,53 @@ async def received_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid email. Enter again:")
         return ASK_EMAIL
     user_id = update.effective_user.id
-    data = storage.get_user_data(user_id) or {}
-    data["email"] = email
-    storage.save_user_data(user_id, data)
+    async with storage.user_lock(user_id):
+        data = await storage.aget_profile(user_id, months=()) or {}
+        data["email"] = email
+        await storage.asave_profile(user_id, data)
     await update.message.reply_text(f"✅ Email updated to {email}.")
     return ConversationHandler.END
 
 # -------------------- MAIN --------------------
 
+async def on_startup(app):
+    # Loads the user manifest (building it on the first run) before any handler needs it
+    await storage.run_blocking(storage.load_manifest)
+    await storage.run_blocking(auth.load)
+    await instrumentation.start_metrics_server()
+
+async def on_shutdown(app):
+    await instrumentation.stop_metrics_server()
+    await currency.close()
+    await mailer.close()
+    await receipts.close()
+    await downloads.close()
+    charts.close()
+    # Write back any cached changes that haven't been flushed yet
+    storage.shutdown()
+
 load_dotenv()
-if __name__ == "__main__":
-    app = ApplicationBuilder().token(os.getenv("BOT_TOKEN")).build()
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+def build_application():
+    # Shared by polling mode below and the sharded workers in webhook.py
+    # Updates from different users run side by side, each user's one at a time (see utils/updates.py)
+    concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", 64))
+    builder = (
+        ApplicationBuilder()
+        .token(os.getenv("BOT_TOKEN"))
+        .concurrent_updates(PerUserUpdateProcessor(concurrent_updates))
+        # Times every Bot API call; same pool size PTB uses by default
+        .request(instrumentation.InstrumentedRequest(connection_pool_size=256))
+        # Conversations and user_data survive restarts, so nobody is dropped mid-flow
+        .persistence(SessionPersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        # A local stand-in for the Bot API, e.g. python -m bench.feeder
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    app = builder.build()
 
     # Conversations
     conv = ConversationHandler(
@@ -302,31 +566,49 @@ if __name__ == "__main__":
             ASK_PIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_pin)],
             VERIFY_PIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, verify_pin)]
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="start_conversation",
+        persistent=True,
     )
 
     recur_conv = ConversationHandler(
         entry_points=[CommandHandler("recurring", set_recurring)],
         states={ADD_RECUR: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_recurring)]},
-        fallbacks=[]
+        fallbacks=[],
+        name="recurring_conversation",
+        persistent=True,
     )
 
     limit_conv = ConversationHandler(
         entry_points=[CommandHandler("limit", set_limit)],
         states={SET_LIMIT: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_limit)]},
-        fallbacks=[]
+        fallbacks=[],
+        name="limit_conversation",
+        persistent=True,
     )
 
     budget_conv = ConversationHandler(
         entry_points=[CommandHandler("setbudget", set_budget)],
         states={SET_BUDGET: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_budget)]},
-        fallbacks=[]
+        fallbacks=[],
+        name="budget_conversation",
+        persistent=True,
     )
 
     email_conv = ConversationHandler(
         entry_points=[CommandHandler("setemail", set_email)],
         states={SET_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_email)]},
-        fallbacks=[]
+        fallbacks=[],
+        name="email_conversation",
+        persistent=True,
+    )
+
+    import_conv = ConversationHandler(
+        entry_points=[CommandHandler("import", import_command)],
+        states={IMPORT_FILE: [MessageHandler(filters.Document.ALL, receive_import)]},
+        fallbacks=[],
+        name="import_conversation",
+        persistent=True,
     )
 
     settings_conv_handler = ConversationHandler(
@@ -341,24 +623,33 @@ if __name__ == "__main__":
         },
         fallbacks=[],
         name="settings_conversation",
-        persistent=False,
+        persistent=True,
     )
 
     # Register handlers
+    app.add_handler(TypeHandler(Update, auth_gate), group=-1)
     app.add_handler(conv)
     app.add_handler(recur_conv)
     app.add_handler(limit_conv)
     app.add_handler(budget_conv)
     app.add_handler(email_conv)
+    app.add_handler(import_conv)
     app.add_handler(settings_conv_handler)
     app.add_handler(CommandHandler("add", add_expense))
     app.add_handler(CommandHandler("summary", summary))
     app.add_handler(CommandHandler("upload", upload_command))
     app.add_handler(CommandHandler("export", export_csv))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(CommandHandler("chart", chart))
+    app.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
+    app.add_handler(CommandHandler("stats", instrumentation.stats))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, add_expense))
 
+    # Per-handler latency for everything registered above
+    instrumentation.instrument_application(app)
+
     # Start background jobs
-    schedule_jobs(app.bot)
+    schedule_jobs(app)
+    return app
 
-    app.run_polling()
+if __name__ == "__main__":
+    build_application().run_polling()
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from utils import currency
+
+RATES = {"EUR": 0.5, "GBP": 0.25}
+
+class FakeRateServer:
+    # Stands in for the exchange rate API: counts requests, can be made slow or failing
+    def __init__(self, rates=RATES, delay=0, status=200):
+        self.rates = dict(rates)
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return httpx.Response(self.status, json={"error": "unavailable"})
+        return httpx.Response(200, json={"base": "USD", "rates": self.rates})
+
+    def provider(self, tmp_path, ttl=3600):
+        return currency.RateProvider(
+            url="http://rates.test/latest", ttl=ttl,
+            snapshot_path=str(tmp_path / "rates.json"), transport=httpx.MockTransport(self.handle),
+        )
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_rates_are_cached_for_the_ttl(tmp_path):
+    server = FakeRateServer()
+    provider = server.provider(tmp_path)
+
+    async def scenario():
+        first = await provider.get_rates()
+        second = await provider.get_rates()
+        await provider.close()
+        return first, second
+
+    first, second = run(scenario())
+    assert first == second == {**RATES, "USD": 1.0}
+    assert server.requests == 1
+
+def test_expired_rates_are_served_while_refreshing(tmp_path):
+    server = FakeRateServer()
+    provider = server.provider(tmp_path)
+
+    async def scenario():
+        await provider.get_rates()
+        provider._fetched_at = time.time() - provider.ttl  # Let the TTL run out
+        server.rates["EUR"] = 0.6
+        stale = await provider.get_rates()
+        await provider._inflight
+        fresh = await provider.get_rates()
+        await provider.close()
+        return stale, fresh
+
+    stale, fresh = run(scenario())
+    assert stale["EUR"] == 0.5
+    assert fresh["EUR"] == 0.6
+    assert server.requests == 2
+
+def test_concurrent_callers_share_one_fetch(tmp_path):
+    server = FakeRateServer(delay=0.05)
+    provider = server.provider(tmp_path)
+
+    async def scenario():
+        results = await asyncio.gather(*(provider.get_rates() for _ in range(20)))
+        await provider.close()
+        return results
+
+    results = run(scenario())
+    assert server.requests == 1
+    assert all(rates == results[0] for rates in results)
+
+def test_failed_fetch_falls_back_to_the_snapshot(tmp_path):
+    snapshot = {"fetched_at": time.time() - 7200, "rates": {"USD": 1.0, "EUR": 0.4}}
+    (tmp_path / "rates.json").write_text(json.dumps(snapshot))
+    server = FakeRateServer(status=503)
+    provider = server.provider(tmp_path)
+
+    async def scenario():
+        rates = await provider.get_rates()
+        await provider._inflight  # The background refresh fails
+        again = await provider.get_rates()
+        await provider.close()
+        return rates, again
+
+    rates, again = run(scenario())
+    assert rates == again == snapshot["rates"]
+    assert server.requests == 1  # Not retried before RATES_RETRY_AFTER
+
+def test_failed_fetch_without_snapshot_raises(tmp_path):
+    provider = FakeRateServer(status=503).provider(tmp_path)
+
+    async def scenario():
+        try:
+            await provider.get_rates()
+        finally:
+            await provider.close()
+
+    with pytest.raises(RuntimeError):
+        run(scenario())
+
+def test_convert_many(tmp_path, monkeypatch):
+    server = FakeRateServer()
+    monkeypatch.setattr(currency, "provider", server.provider(tmp_path))
+    expenses = [
+        {"amount": 10, "category": "food"},
+        {"amount": 10, "category": "taxi", "currency": "GBP"},
+    ]
+
+    async def scenario():
+        converted = await currency.convert_many(expenses, "eur", default_currency="USD")
+        await currency.close()
+        return converted
+
+    converted = run(scenario())
+    assert converted == [
+        {"amount": 5.0, "category": "food", "currency": "EUR"},
+        {"amount": 20.0, "category": "taxi", "currency": "EUR"},
+    ]
+    assert server.requests == 1
+    with pytest.raises(ValueError):
+        run(currency.convert_many(expenses, "XXX"))
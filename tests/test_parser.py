@@ -0,0 +1,35 @@
+import pytest
+
+from utils.parser import parse_amount, parse_expenses, parse_expense_message
+
+@pytest.mark.parametrize("text, amount", [
+    ("1,234", 1234.0),
+    ("1,234,567", 1234567.0),
+    ("1,234.50", 1234.5),
+    ("1,5", 1.5),
+    ("12,34", 12.34),
+    ("12.34", 12.34),
+    ("50", 50.0),
+])
+def test_parse_amount(text, amount):
+    assert parse_amount(text) == amount
+
+@pytest.mark.parametrize("text, expected", [
+    ("spent 1,234 on rent", [{"amount": 1234.0, "category": "rent"}]),
+    ("lunch 12,34", [{"amount": 12.34, "category": "lunch"}]),
+    ("coffee 1,5", [{"amount": 1.5, "category": "coffee"}]),
+    ("coffee 3, lunch 12", [{"amount": 3.0, "category": "coffee"}, {"amount": 12.0, "category": "lunch"}]),
+    ("coffee 3;taxi 5\nlunch 12", [
+        {"amount": 3.0, "category": "coffee"}, {"amount": 5.0, "category": "taxi"}, {"amount": 12.0, "category": "lunch"},
+    ]),
+    ("2026-01-03 taxi 18 airport", [
+        {"amount": 18.0, "category": "taxi", "description": "airport", "date": "2026-01-03T00:00:00"},
+    ]),
+])
+def test_parse_expenses(text, expected):
+    assert parse_expenses(text) == expected
+
+@pytest.mark.parametrize("text", ["", "   ", None, "/add", "lunch", "spent -5 on food", "food 2026-13-45"])
+def test_rejected_input(text):
+    assert parse_expenses(text) == []
+    assert parse_expense_message(text) is None
@@ -0,0 +1,37 @@
+import asyncio
+
+from telegram import Chat, Message, Update, User
+
+from utils.updates import PerUserUpdateProcessor
+
+def message_update(update_id, user_id):
+    user = User(user_id, "Test", False)
+    message = Message(update_id, None, Chat(user_id, "private"), from_user=user, text="hi")
+    return Update(update_id, message=message)
+
+def test_one_users_updates_run_in_order_and_users_overlap():
+    processor = PerUserUpdateProcessor(16)
+    running = {1: 0, 2: 0}
+    overlap = {"same_user": 0, "users": 0}
+    order = []
+
+    async def handle(update_id, user_id):
+        running[user_id] += 1
+        if running[user_id] > 1:
+            overlap["same_user"] += 1
+        if running[1] and running[2]:
+            overlap["users"] += 1
+        await asyncio.sleep(0.01)
+        order.append((user_id, update_id))
+        running[user_id] -= 1
+
+    async def scenario():
+        updates = [(i, 1 if i % 2 else 2) for i in range(10)]
+        await asyncio.gather(*(
+            processor.process_update(message_update(i, user_id), handle(i, user_id)) for i, user_id in updates
+        ))
+
+    asyncio.run(scenario())
+    assert overlap["same_user"] == 0
+    assert overlap["users"] > 0
+    assert [i for user_id, i in order if user_id == 1] == [1, 3, 5, 7, 9]
@@ -0,0 +1,28 @@
+import multiprocessing
+
+import webhook
+
+def report_shard(results):
+    # Runs in the spawned child; utils.sharding was imported there before this call
+    from utils import sharding
+    results.put((sharding.SHARD_INDEX, sharding.SHARD_COUNT))
+
+def test_spawned_workers_report_their_shard():
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = []
+    for index in range(3):
+        process = context.Process(target=report_shard, args=(results,))
+        with webhook.shard_env(index, 3):
+            process.start()
+        processes.append(process)
+    reported = sorted(results.get(timeout=30) for _ in processes)
+    for process in processes:
+        process.join(timeout=30)
+    assert reported == [(0, 3), (1, 3), (2, 3)]
+
+def test_shard_env_is_restored():
+    before = dict(webhook.os.environ)
+    with webhook.shard_env(1, 4):
+        assert webhook.os.environ["SHARD_INDEX"] == "1"
+    assert dict(webhook.os.environ) == before
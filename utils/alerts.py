@@ -0,0 +1,74 @@
+import os
+from datetime import datetime
+
+from . import storage
+
+# Fractions of the monthly budget or a category limit that trigger an alert
+ALERT_THRESHOLDS = sorted(float(t) for t in os.getenv("ALERT_THRESHOLDS", "0.8,1.0").split(","))
+
+# Alerts already sent live on the profile so each threshold fires once per month:
+#   {"alerts_sent": {"month": "2026-10", "budget": 0.8, "categories": {"food": 1.0}}}
+
+def _crossed(spent, cap, already):
+    # Highest threshold spent has reached that wasn't alerted on yet, or None
+    if not cap or cap <= 0:
+        return None
+    reached = [t for t in ALERT_THRESHOLDS if spent >= cap * t]
+    if not reached or reached[-1] <= already:
+        return None
+    return reached[-1]
+
+def _message(label, spent, cap, threshold, currency):
+    if threshold >= 1:
+        return f"🚨 {label} overspent: {spent:.2f} of {cap:.2f} {currency} (over by {spent - cap:.2f})"
+    return f"⚠️ {label} at {spent / cap:.0%}: {spent:.2f} of {cap:.2f} {currency}"
+
+def evaluate(profile, month):
+    # Messages for thresholds newly crossed in month, recording them on the profile
+    bucket = profile.get("rollups", {}).get(month, {})
+    sent = profile.get("alerts_sent") or {}
+    if sent.get("month") != month:
+        sent = {"month": month}
+    currency = profile.get("currency", "USD")
+    messages = []
+
+    threshold = _crossed(bucket.get("total", 0), profile.get("budget"), sent.get("budget", 0))
+    if threshold:
+        messages.append(_message("Monthly budget", bucket.get("total", 0), profile["budget"], threshold, currency))
+        sent["budget"] = threshold
+    categories = bucket.get("categories", {})
+    sent_categories = sent.setdefault("categories", {})
+    for cat, cap in (profile.get("category_limits") or {}).items():
+        spent = categories.get(cat, 0)
+        threshold = _crossed(spent, cap, sent_categories.get(cat, 0))
+        if threshold:
+            messages.append(_message(cat.capitalize(), spent, cap, threshold, currency))
+            sent_categories[cat] = threshold
+
+    if messages:
+        profile["alerts_sent"] = sent
+    return messages
+
+def reset(profile, category=None):
+    # Call when the budget (or a category's limit) changes so its alerts can fire again
+    sent = profile.get("alerts_sent")
+    if not sent:
+        return
+    if category is None:
+        sent.pop("budget", None)
+    else:
+        sent.get("categories", {}).pop(category, None)
+
+async def check(user_id, expenses):
+    # Run under storage.user_lock right after expenses were stored. Only the current
+    # month is evaluated, from its rollups, so this costs one month read per write
+    month = datetime.now().strftime("%Y-%m")
+    if not any(e["date"].startswith(month) for e in expenses):
+        return []
+    profile = await storage.aget_profile(user_id, [month])
+    if not profile:
+        return []
+    messages = evaluate(profile, month)
+    if messages:
+        await storage.asave_profile(user_id, profile)
+    return messages
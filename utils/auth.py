@@ -0,0 +1,139 @@
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+from . import metrics, sharding, storage
+from .manifest import JournaledIndex
+
+# PINs live here, never in the encrypted profiles or ledgers:
+#   {"salt": "...", "hash": "...", "failures": 0, "locked_until": 0, "verified_until": 1760000000}
+# Only salted scrypt hashes are stored, so the store is plain JSON. One per shard.
+AUTH_PATH = os.path.join(
+    storage.DATA_DIR, "auth.json" if sharding.SHARD_COUNT == 1 else f"auth.{sharding.SHARD_INDEX}.json",
+)
+# A verified PIN is good for this many seconds (survives restarts)
+AUTH_SESSION_TTL = float(os.getenv("AUTH_SESSION_TTL", 12 * 3600))
+# Wrong PINs allowed before a lockout; every further round doubles the lockout
+AUTH_MAX_ATTEMPTS = int(os.getenv("AUTH_MAX_ATTEMPTS", 5))
+AUTH_LOCKOUT = float(os.getenv("AUTH_LOCKOUT", 300))
+# scrypt cost: about 50ms and 16 MB per hash, paid on the storage pool
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+
+_store = JournaledIndex(AUTH_PATH)
+_sessions = {}  # user_id -> wall-clock expiry of the verified session
+_no_pin = set()  # users checked for a legacy profile PIN and found without any PIN
+_lock = threading.Lock()
+
+def _hash(pin, salt):
+    with metrics.timer("crypto", "pin_hash"):
+        return hashlib.scrypt(pin.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+
+def load():
+    # Call at startup; verified sessions that haven't expired carry over a restart
+    if _store.loaded():
+        return
+    _store.load(dict)
+    now = time.time()
+    with _lock:
+        for user_id, entry in _store.entries().items():
+            if (entry.get("verified_until") or 0) > now:
+                _sessions[user_id] = entry["verified_until"]
+
+def has_pin(user_id):
+    # Blocking the first time a user without an auth entry is seen (their profile
+    # is checked for a legacy PIN), a lookup after that
+    load()
+    user_id = str(user_id)
+    if _store.get(user_id) is not None:
+        return True
+    if user_id in _no_pin:
+        return False
+    migrated = _migrate_legacy_pin(user_id)
+    if not migrated:
+        with _lock:
+            _no_pin.add(user_id)
+    return migrated
+
+async def ahas_pin(user_id):
+    user_id = str(user_id)
+    if _store.loaded():
+        if _store.get(user_id) is not None:
+            return True
+        if user_id in _no_pin:
+            return False
+    # May migrate a legacy PIN, which rewrites the profile
+    async with storage.user_lock(user_id):
+        return await storage.run_blocking(has_pin, user_id)
+
+def is_verified(user_id):
+    # The per-message check: a dict lookup, no disk and no hashing
+    expiry = _sessions.get(str(user_id))
+    return expiry is not None and expiry > time.time()
+
+def _start_session(user_id):
+    expiry = time.time() + AUTH_SESSION_TTL
+    with _lock:
+        _sessions[user_id] = expiry
+    return expiry
+
+def set_pin(user_id, pin, verified=True):
+    # Blocking (scrypt); also starts a verified session, since the user just chose it
+    load()
+    user_id = str(user_id)
+    salt = secrets.token_bytes(16)
+    _store.update(
+        user_id, salt=salt.hex(), hash=_hash(pin, salt).hex(), failures=0, locked_until=0,
+        verified_until=_start_session(user_id) if verified else 0,
+    )
+    _store.flush()
+    with _lock:
+        _no_pin.discard(user_id)
+
+def _migrate_legacy_pin(user_id):
+    # PINs used to be stored in plaintext in the profile; move it here the first time
+    profile = storage.get_profile(user_id, months=())
+    pin = (profile or {}).pop("pin", None)
+    if not pin:
+        return False
+    set_pin(user_id, pin, verified=False)  # Migrating isn't the same as verifying
+    storage.save_profile(user_id, profile)
+    return True
+
+def verify_pin(user_id, pin):
+    # Blocking (scrypt). Returns (ok, seconds until the lockout ends or None).
+    # Not safe to run twice at once for one user; use averify_pin
+    if not has_pin(user_id):
+        return False, None
+    user_id = str(user_id)
+    entry = _store.get(user_id)
+    now = time.time()
+    if entry.get("locked_until", 0) > now:
+        return False, entry["locked_until"] - now
+
+    if hmac.compare_digest(_hash(pin, bytes.fromhex(entry["salt"])).hex(), entry["hash"]):
+        _store.update(user_id, failures=0, locked_until=0, verified_until=_start_session(user_id))
+        _store.flush()
+        return True, None
+
+    failures = entry.get("failures", 0) + 1
+    fields = {"failures": failures}
+    if failures % AUTH_MAX_ATTEMPTS == 0:
+        fields["locked_until"] = now + AUTH_LOCKOUT * 2 ** (failures // AUTH_MAX_ATTEMPTS - 1)
+    _store.update(user_id, **fields)
+    _store.flush()
+    return False, (fields["locked_until"] - now) if "locked_until" in fields else None
+
+# The async API holds the user's lock around each call: parallel wrong PINs would
+# otherwise read the same failure count and lose increments, and a legacy PIN
+# migration could overwrite a concurrent settings change to the profile
+
+async def aset_pin(user_id, pin):
+    async with storage.user_lock(user_id):
+        return await storage.run_blocking(set_pin, user_id, pin)
+
+async def averify_pin(user_id, pin):
+    async with storage.user_lock(user_id):
+        return await storage.run_blocking(verify_pin, user_id, pin)
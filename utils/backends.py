@@ -0,0 +1,712 @@
+import base64
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from cryptography.fernet import InvalidToken
+
+from . import codec, metrics, rollups
+
+EXPENSE_FIELDS = ("date", "amount", "category")
+
+def atomic_write(path, payload):
+    # Write to a temp file next to the target and rename it over, so readers
+    # only ever see the old file or the complete new one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def filter_expenses(expenses, start=None, end=None, category=None):
+    # start is inclusive and end exclusive; both are ISO date or datetime strings
+    for e in expenses:
+        if start is not None and e["date"] < start:
+            continue
+        if end is not None and e["date"] >= end:
+            continue
+        if category is not None and e.get("category") != category:
+            continue
+        yield e
+
+# Fernet tokens are base64 text, a third bigger than the bytes they encode. Whole
+# files and SQLite blobs store the decoded token instead; journals keep the text
+# form since their records are newline-separated. A decoded token starts with
+# Fernet's version byte 0x80, the text form with "gAAAAA", so reads accept both.
+FERNET_VERSION = b"\x80"
+
+def encode_payload(fernet, value, binary=False):
+    # Serialization and encryption are timed apart so either can be spotted as the bottleneck
+    raw = codec.encode(value)
+    with metrics.timer("crypto", "encrypt"):
+        token = fernet.encrypt(raw)
+    # With PAYLOAD_FORMAT=json everything is written exactly as before, text tokens included
+    if binary and codec.PAYLOAD_FORMAT != "json":
+        token = base64.urlsafe_b64decode(token)
+    metrics.observe_size("payload_bytes", "encrypted", len(token))
+    return token
+
+def decode_payload(fernet, token):
+    metrics.observe_size("payload_bytes", "encrypted", len(token))
+    if token[:1] == FERNET_VERSION:
+        token = base64.urlsafe_b64encode(token)
+    with metrics.timer("crypto", "decrypt"):
+        raw = fernet.decrypt(token)
+    return codec.decode(raw)
+
+def same_expense(a, b):
+    # Expenses have no ids; date, amount and category together pick one out
+    return (a["date"], a["amount"], a.get("category", "misc")) == (b["date"], b["amount"], b.get("category", "misc"))
+
+def _is_user_id(name):
+    # Telegram ids; keeps encrypted_data.json, rates.json and the keys/ dir out of user listings
+    return name.lstrip("-").isdigit()
+
+def journal_mark(path):
+    # Stored in a snapshot to record which journal it folded in, and how much of
+    # it: a hash of the first record (Fernet tokens never repeat) and the size.
+    # A crash between writing the snapshot and deleting the journal then can't
+    # replay those records twice. None when there's no journal
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        first = f.readline().strip()
+        size = f.seek(0, os.SEEK_END)
+    return {"head": hashlib.sha256(first).hexdigest()[:16], "bytes": size}
+
+def read_journal(path, fernet, user_id, folded=None):
+    # Each line is one (text) Fernet token holding a list of expenses. folded is
+    # the journal_mark stored in the snapshot; records it covers are skipped
+    if not os.path.exists(path):
+        return []
+    expenses = []
+    with open(path, "rb") as f:
+        if folded is not None:
+            first = f.readline().strip()
+            same_journal = hashlib.sha256(first).hexdigest()[:16] == folded["head"]
+            f.seek(folded["bytes"] if same_journal else 0)
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                expenses.extend(decode_payload(fernet, line))
+            except InvalidToken:
+                # A torn trailing write after a crash; the rest of the journal is still valid
+                print(f"[WARNING] Skipping unreadable journal record for user {user_id}")
+    return expenses
+
+def append_journal(path, record):
+    record += b"\n"
+    with metrics.timer("storage_io", "append"), open(path, "a+b") as f:
+        # Start a fresh line if a previous append was torn by a crash
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                record = b"\n" + record
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+
+class StorageBackend:
+    # Whether iter_expenses can answer range queries without loading the whole ledger
+    indexed = False
+
+    def load(self, user_id):
+        raise NotImplementedError
+
+    def load_readonly(self, user_id):
+        # Like load, but never rewrites or removes anything on disk (for copying data out)
+        return self.load(user_id)
+
+    def load_profile(self, user_id):
+        # Settings only: no expenses, no rollups
+        data = self.load(user_id)
+        if data is not None:
+            data.pop("expenses", None)
+            data.pop("rollups", None)
+        return data
+
+    def load_rollups(self, user_id, months=None):
+        # Rollup buckets for the given "YYYY-MM" months, or all of them
+        totals = (self.load(user_id) or {}).get("rollups", {})
+        if months is None:
+            return totals
+        return {month: totals[month] for month in months if month in totals}
+
+    def save(self, user_id, data):
+        raise NotImplementedError
+
+    def save_profile(self, user_id, profile):
+        data = self.load(user_id) or {"expenses": []}
+        data.update(profile)
+        return self.save(user_id, data)
+
+    def append_expenses(self, user_id, expenses):
+        raise NotImplementedError
+
+    def iter_expenses(self, user_id, start=None, end=None, category=None):
+        data = self.load(user_id) or {}
+        return filter_expenses(data.get("expenses", []), start, end, category)
+
+    def update_expense(self, user_id, expense, changes):
+        # Merges changes into the latest stored expense matching expense; False if there is none
+        data = self.load(user_id)
+        for e in reversed((data or {}).get("expenses", [])):
+            if same_expense(e, expense):
+                e.update(changes)
+                return self.save(user_id, data)
+        return False
+
+    def list_users(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+# -------------------- ENCRYPTED JSON --------------------
+
+class EncryptedJsonBackend(StorageBackend):
+    # One Fernet snapshot per user in <data_dir>/<user_id>.json, plus an
+    # append-only journal of new expenses that is folded in once it grows
+    def __init__(self, data_dir, fernet_for, journal_compact_bytes=64 * 1024):
+        self.data_dir = data_dir
+        self._fernet_for = fernet_for
+        self.journal_compact_bytes = journal_compact_bytes
+
+    def _get_file(self, user_id):
+        return os.path.join(self.data_dir, f"{user_id}.json")
+
+    def _get_journal_file(self, user_id):
+        return os.path.join(self.data_dir, f"{user_id}.journal")
+
+    def load(self, user_id):
+        path = self._get_file(user_id)
+        has_journal = os.path.exists(self._get_journal_file(user_id))
+        if not os.path.exists(path) and not has_journal:
+            return None
+
+        fernet = self._fernet_for(user_id)
+        data = {}
+        folded = None
+        if os.path.exists(path):
+            with metrics.timer("storage_io", "read"), open(path, "rb") as f:
+                token = f.read()
+            try:
+                data = decode_payload(fernet, token)
+            except Exception as e:
+                print(f"[ERROR] Failed to decrypt data for user {user_id}: {e}")
+                return None  # Optionally: os.remove(path) to reset corrupted files
+            folded = data.pop("journal_folded", None)
+
+        expenses = data.setdefault("expenses", [])
+        if "rollups" not in data:
+            # Files written before rollups existed
+            data["rollups"] = rollups.build(expenses)
+        if has_journal:
+            journaled = read_journal(self._get_journal_file(user_id), fernet, user_id, folded)
+            expenses.extend(journaled)
+            for e in journaled:
+                rollups.apply(data["rollups"], e)
+        return data
+
+    def save(self, user_id, data):
+        fernet = self._fernet_for(user_id)
+        # data holds everything journaled so far; the mark keeps a crash before
+        # the journal is removed below from replaying it on top
+        mark = journal_mark(self._get_journal_file(user_id))
+        try:
+            encrypted = encode_payload(fernet, {**data, "journal_folded": mark} if mark else data, binary=True)
+            with metrics.timer("storage_io", "write"):
+                atomic_write(self._get_file(user_id), encrypted)
+        except Exception as e:
+            print(f"[ERROR] Failed to save data for user {user_id}: {e}")
+            return False
+        # The snapshot now holds everything the journal did
+        journal = self._get_journal_file(user_id)
+        if os.path.exists(journal):
+            os.remove(journal)
+        return True
+
+    def append_expenses(self, user_id, expenses):
+        journal = self._get_journal_file(user_id)
+        fernet = self._fernet_for(user_id)
+        try:
+            append_journal(journal, encode_payload(fernet, expenses))
+        except Exception as e:
+            print(f"[ERROR] Failed to append expenses for user {user_id}: {e}")
+            return False
+        if os.path.getsize(journal) >= self.journal_compact_bytes:
+            data = self.load(user_id)
+            if data is not None:
+                self.save(user_id, data)
+        return True
+
+    def list_users(self):
+        users = set()
+        for name in os.listdir(self.data_dir):
+            user_id, ext = os.path.splitext(name)
+            if ext in (".json", ".journal") and _is_user_id(user_id):
+                users.add(user_id)
+        return sorted(users)
+
+# -------------------- PARTITIONED --------------------
+
+PROFILE_FILE = "profile.json"
+MONTH_RE = re.compile(r"\d{4}-\d{2}")
+
+class PartitionedBackend(StorageBackend):
+    # One directory per user: profile.json holds the settings (currency, budget,
+    # limits, email, PIN) and each month of expenses is its own segment,
+    # <YYYY-MM>.json, carrying that month's rollup, plus a <YYYY-MM>.journal of
+    # appends. Reads decrypt only the months they cover.
+    indexed = True
+
+    def __init__(self, data_dir, fernet_for, journal_compact_bytes=64 * 1024):
+        self.data_dir = data_dir
+        self._fernet_for = fernet_for
+        self.journal_compact_bytes = journal_compact_bytes
+        # Users still in the one-file layout are split up on first access
+        self._legacy = EncryptedJsonBackend(data_dir, fernet_for, journal_compact_bytes)
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.data_dir, user_id)
+
+    def _profile_file(self, user_id):
+        return os.path.join(self.data_dir, user_id, PROFILE_FILE)
+
+    def _segment_file(self, user_id, month):
+        return os.path.join(self.data_dir, user_id, f"{month}.json")
+
+    def _journal_file(self, user_id, month):
+        return os.path.join(self.data_dir, user_id, f"{month}.journal")
+
+    def _legacy_files(self, user_id):
+        return [self._legacy._get_file(user_id), self._legacy._get_journal_file(user_id)]
+
+    def _upgrade_legacy(self, user_id):
+        if not any(os.path.exists(path) for path in self._legacy_files(user_id)):
+            return
+        data = self._legacy.load(user_id)
+        if data is not None:
+            self.save(user_id, data)  # Removes the old files once everything is written
+
+    def _months(self, user_id):
+        try:
+            names = os.listdir(self._user_dir(user_id))
+        except FileNotFoundError:
+            return []
+        stems = {os.path.splitext(name)[0] for name in names}
+        return sorted(stem for stem in stems if MONTH_RE.fullmatch(stem))
+
+    def _load_segment(self, user_id, month, fernet):
+        # {"expenses": [...], "rollups": {month: bucket}} with the month's journal folded in
+        segment = {"expenses": [], "rollups": {}}
+        path = self._segment_file(user_id, month)
+        if os.path.exists(path):
+            with metrics.timer("storage_io", "read"), open(path, "rb") as f:
+                token = f.read()
+            segment = decode_payload(fernet, token)
+        folded = segment.pop("journal_folded", None)
+        journaled = read_journal(self._journal_file(user_id, month), fernet, user_id, folded)
+        segment["expenses"].extend(journaled)
+        for e in journaled:
+            rollups.apply(segment["rollups"], e)
+        return segment
+
+    def _read_segments(self, user_id, months):
+        fernet = self._fernet_for(user_id)
+        for month in months:
+            try:
+                yield month, self._load_segment(user_id, month, fernet)
+            except Exception as e:
+                print(f"[ERROR] Failed to read {month} for user {user_id}: {e}")
+
+    def _write_segment(self, user_id, month, expenses, fernet):
+        segment = {"expenses": expenses, "rollups": rollups.build(expenses)}
+        journal = self._journal_file(user_id, month)
+        mark = journal_mark(journal)  # See EncryptedJsonBackend.save
+        if mark:
+            segment["journal_folded"] = mark
+        encrypted = encode_payload(fernet, segment, binary=True)
+        with metrics.timer("storage_io", "write"):
+            atomic_write(self._segment_file(user_id, month), encrypted)
+        if os.path.exists(journal):
+            os.remove(journal)
+
+    def load_profile(self, user_id):
+        self._upgrade_legacy(user_id)
+        return self._read_profile(user_id)
+
+    def _read_profile(self, user_id):
+        path = self._profile_file(user_id)
+        if not os.path.exists(path):
+            # Expenses added before /start still make the user known
+            return {} if self._months(user_id) else None
+        with metrics.timer("storage_io", "read"), open(path, "rb") as f:
+            token = f.read()
+        try:
+            return decode_payload(self._fernet_for(user_id), token)
+        except Exception as e:
+            print(f"[ERROR] Failed to decrypt profile for user {user_id}: {e}")
+            return None
+
+    def load_rollups(self, user_id, months=None):
+        self._upgrade_legacy(user_id)
+        stored = self._months(user_id)
+        if months is not None:
+            wanted = set(months)
+            stored = [month for month in stored if month in wanted]
+        totals = {}
+        for month, segment in self._read_segments(user_id, stored):
+            totals.update(segment["rollups"])
+        return totals
+
+    def load(self, user_id):
+        self._upgrade_legacy(user_id)
+        return self._read_all(user_id)
+
+    def load_readonly(self, user_id):
+        # A user still in the one-file layout is read from there instead of upgraded;
+        # those files hold everything until the upgrade removes them
+        if any(os.path.exists(path) for path in self._legacy_files(user_id)):
+            return self._legacy.load(user_id)
+        return self._read_all(user_id)
+
+    def _read_all(self, user_id):
+        data = self._read_profile(user_id)
+        if data is None:
+            return None
+        fernet = self._fernet_for(user_id)
+        expenses, totals = [], {}
+        for month in self._months(user_id):
+            try:
+                segment = self._load_segment(user_id, month, fernet)
+            except Exception as e:
+                # A partial document must never be saved back over the missing months
+                print(f"[ERROR] Failed to read {month} for user {user_id}: {e}")
+                return None
+            expenses.extend(segment["expenses"])
+            totals.update(segment["rollups"])
+        data["expenses"] = expenses
+        data["rollups"] = totals
+        return data
+
+    def save(self, user_id, data):
+        fernet = self._fernet_for(user_id)
+        by_month = {}
+        for e in data.get("expenses", []):
+            by_month.setdefault(e["date"][:7], []).append(e)
+        try:
+            os.makedirs(self._user_dir(user_id), exist_ok=True)
+            for month, expenses in by_month.items():
+                self._write_segment(user_id, month, expenses, fernet)
+            for month in self._months(user_id):
+                if month not in by_month:
+                    for path in (self._segment_file(user_id, month), self._journal_file(user_id, month)):
+                        if os.path.exists(path):
+                            os.remove(path)
+        except Exception as e:
+            print(f"[ERROR] Failed to save data for user {user_id}: {e}")
+            return False
+        if not self.save_profile(user_id, data):
+            return False
+        for path in self._legacy_files(user_id):
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+    def save_profile(self, user_id, profile):
+        profile = {k: v for k, v in profile.items() if k not in ("expenses", "rollups")}
+        try:
+            os.makedirs(self._user_dir(user_id), exist_ok=True)
+            encrypted = encode_payload(self._fernet_for(user_id), profile, binary=True)
+            with metrics.timer("storage_io", "write"):
+                atomic_write(self._profile_file(user_id), encrypted)
+        except Exception as e:
+            print(f"[ERROR] Failed to save profile for user {user_id}: {e}")
+            return False
+        return True
+
+    def append_expenses(self, user_id, expenses):
+        self._upgrade_legacy(user_id)
+        fernet = self._fernet_for(user_id)
+        by_month = {}
+        for e in expenses:
+            by_month.setdefault(e["date"][:7], []).append(e)
+        try:
+            os.makedirs(self._user_dir(user_id), exist_ok=True)
+            for month, batch in by_month.items():
+                append_journal(self._journal_file(user_id, month), encode_payload(fernet, batch))
+        except Exception as e:
+            print(f"[ERROR] Failed to append expenses for user {user_id}: {e}")
+            return False
+        for month in by_month:
+            # Compaction rewrites only the month that grew
+            if os.path.getsize(self._journal_file(user_id, month)) >= self.journal_compact_bytes:
+                try:
+                    segment = self._load_segment(user_id, month, fernet)
+                    self._write_segment(user_id, month, segment["expenses"], fernet)
+                except Exception as e:
+                    print(f"[WARNING] Failed to compact {month} for user {user_id}: {e}")
+        return True
+
+    def update_expense(self, user_id, expense, changes):
+        self._upgrade_legacy(user_id)
+        month = expense["date"][:7]
+        fernet = self._fernet_for(user_id)
+        try:
+            segment = self._load_segment(user_id, month, fernet)
+            for e in reversed(segment["expenses"]):
+                if same_expense(e, expense):
+                    e.update(changes)
+                    # Only this month is rewritten
+                    self._write_segment(user_id, month, segment["expenses"], fernet)
+                    return True
+        except Exception as e:
+            print(f"[ERROR] Failed to update an expense for user {user_id}: {e}")
+        return False
+
+    def iter_expenses(self, user_id, start=None, end=None, category=None):
+        self._upgrade_legacy(user_id)
+        months = [
+            month for month in self._months(user_id)
+            if (start is None or month >= start[:7]) and (end is None or month <= end[:7])
+        ]
+        for month, segment in self._read_segments(user_id, months):
+            expenses = sorted(segment["expenses"], key=lambda e: e["date"])
+            yield from filter_expenses(expenses, start, end, category)
+
+    def list_users(self):
+        users = set(self._legacy.list_users())
+        for name in os.listdir(self.data_dir):
+            if _is_user_id(name) and os.path.isdir(os.path.join(self.data_dir, name)):
+                users.add(name)
+        return sorted(users)
+
+# -------------------- SQLITE --------------------
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    profile BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    amount REAL NOT NULL,
+    category TEXT NOT NULL,
+    details BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses (user_id, category);
+CREATE TABLE IF NOT EXISTS rollups (
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    category TEXT NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (user_id, day, category)
+) WITHOUT ROWID;
+"""
+
+class SqliteBackend(StorageBackend):
+    # date, amount and category stay in plain columns so they can be indexed;
+    # the profile (PIN, email, limits...) and free-text expense fields are
+    # Fernet-encrypted with the user's key
+    indexed = True
+
+    def __init__(self, path, fernet_for):
+        self.path = path
+        self._fernet_for = fernet_for
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        conn = self._connect()
+        conn.executescript(SQLITE_SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads, so each storage worker gets its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _encrypt(self, fernet, value):
+        return encode_payload(fernet, value, binary=True)
+
+    def _decrypt(self, fernet, blob):
+        return decode_payload(fernet, blob)
+
+    def _expense_row(self, user_id, fernet, expense):
+        details = {k: v for k, v in expense.items() if k not in EXPENSE_FIELDS}
+        return (
+            user_id,
+            expense["date"],
+            expense["amount"],
+            expense.get("category", "misc"),
+            self._encrypt(fernet, details) if details else None,
+        )
+
+    def _insert_expenses(self, conn, user_id, expenses):
+        fernet = self._fernet_for(user_id)
+        conn.executemany(
+            "INSERT INTO expenses (user_id, date, amount, category, details) VALUES (?, ?, ?, ?, ?)",
+            (self._expense_row(user_id, fernet, e) for e in expenses),
+        )
+        conn.executemany(
+            "INSERT INTO rollups (user_id, day, category, total) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, day, category) DO UPDATE SET total = round(total + excluded.total, 2)",
+            ((user_id, e["date"][:10], e.get("category", "misc"), e["amount"]) for e in expenses),
+        )
+
+    def _load_rollups(self, conn, user_id, months=None):
+        query = "SELECT day, category, total FROM rollups WHERE user_id = ?"
+        params = [user_id]
+        if months is not None:
+            months = list(months)
+            if not months:
+                return {}
+            query += f" AND substr(day, 1, 7) IN ({', '.join('?' * len(months))})"
+            params += months
+        totals = {}
+        rows = conn.execute(query, params)
+        for day, category, total in rows:
+            rollups.apply(totals, {"date": day, "amount": total, "category": category})
+        return totals
+
+    def load_profile(self, user_id):
+        row = self._connect().execute(
+            "SELECT profile FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            profile = self._decrypt(self._fernet_for(user_id), row[0])
+        except InvalidToken:
+            print(f"[ERROR] Failed to decrypt profile for user {user_id}: Invalid token or wrong key.")
+            return None
+        return profile
+
+    def load_rollups(self, user_id, months=None):
+        return self._load_rollups(self._connect(), user_id, months)
+
+    def load(self, user_id):
+        data = self.load_profile(user_id)
+        if data is None:
+            return None
+        data["rollups"] = self.load_rollups(user_id)
+        data["expenses"] = list(self.iter_expenses(user_id))
+        return data
+
+    def save(self, user_id, data):
+        return self.save_many([(user_id, data)])
+
+    def save_many(self, documents):
+        # All documents are written in a single transaction
+        conn = self._connect()
+        try:
+            with conn:
+                for user_id, data in documents:
+                    # Rollups live in their own table, rebuilt from the rows below
+                    profile = {k: v for k, v in data.items() if k not in ("expenses", "rollups")}
+                    conn.execute(
+                        "INSERT INTO users (user_id, profile) VALUES (?, ?) "
+                        "ON CONFLICT (user_id) DO UPDATE SET profile = excluded.profile",
+                        (user_id, self._encrypt(self._fernet_for(user_id), profile)),
+                    )
+                    conn.execute("DELETE FROM expenses WHERE user_id = ?", (user_id,))
+                    conn.execute("DELETE FROM rollups WHERE user_id = ?", (user_id,))
+                    self._insert_expenses(conn, user_id, data.get("expenses", []))
+        except Exception as e:
+            print(f"[ERROR] Failed to save data to {self.path}: {e}")
+            return False
+        return True
+
+    def save_profile(self, user_id, profile):
+        profile = {k: v for k, v in profile.items() if k not in ("expenses", "rollups")}
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO users (user_id, profile) VALUES (?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET profile = excluded.profile",
+                    (user_id, self._encrypt(self._fernet_for(user_id), profile)),
+                )
+        except Exception as e:
+            print(f"[ERROR] Failed to save profile for user {user_id}: {e}")
+            return False
+        return True
+
+    def append_expenses(self, user_id, expenses):
+        conn = self._connect()
+        try:
+            with conn:
+                self._insert_expenses(conn, user_id, expenses)
+        except Exception as e:
+            print(f"[ERROR] Failed to append expenses for user {user_id}: {e}")
+            return False
+        return True
+
+    def update_expense(self, user_id, expense, changes):
+        conn = self._connect()
+        fernet = self._fernet_for(user_id)
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT id, details FROM expenses WHERE user_id = ? AND date = ? AND amount = ? AND category = ? "
+                    "ORDER BY id DESC LIMIT 1",
+                    (user_id, expense["date"], expense["amount"], expense.get("category", "misc")),
+                ).fetchone()
+                if row is None:
+                    return False
+                details = self._decrypt(fernet, row[1]) if row[1] is not None else {}
+                details.update({k: v for k, v in changes.items() if k not in EXPENSE_FIELDS})
+                conn.execute("UPDATE expenses SET details = ? WHERE id = ?", (self._encrypt(fernet, details), row[0]))
+        except Exception as e:
+            print(f"[ERROR] Failed to update an expense for user {user_id}: {e}")
+            return False
+        return True
+
+    def iter_expenses(self, user_id, start=None, end=None, category=None):
+        query = "SELECT date, amount, category, details FROM expenses WHERE user_id = ?"
+        params = [user_id]
+        if start is not None:
+            query += " AND date >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND date < ?"
+            params.append(end)
+        if category is not None:
+            query += " AND category = ?"
+            params.append(category)
+        query += " ORDER BY date, id"
+
+        fernet = self._fernet_for(user_id)
+        for date, amount, cat, details in self._connect().execute(query, params):
+            expense = {"amount": amount, "category": cat, "date": date}
+            if details is not None:
+                expense.update(self._decrypt(fernet, details))
+            yield expense
+
+    def list_users(self):
+        return [row[0] for row in self._connect().execute("SELECT user_id FROM users ORDER BY user_id")]
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+from . import rollups, storage
+
+# Matplotlib is optional; /chart says so instead of failing when it's missing
+AVAILABLE = importlib.util.find_spec("matplotlib") is not None
+PERIODS = ("week", "month", "year")
+# Processes rendering charts, away from the event loop and the GIL
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 2))
+# Charts remembered per (user, period): the digest of the data drawn and the
+# Telegram file_id it was uploaded as, so an unchanged chart is re-sent, not re-rendered
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 4096))
+TOP_CATEGORIES = 8
+
+_executor = None
+_slots = None
+_cache = OrderedDict()  # (user_id, period) -> {"digest": str, "file_id": str}
+_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn, because forking a process that runs threads and an event loop isn't safe
+        _executor = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+def _get_slots():
+    # Bounds charts waiting on the pool during a burst of requests
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(CHART_WORKERS * 2)
+    return _slots
+
+# -------------------- DATA --------------------
+
+def _top(categories):
+    ranked = sorted(categories.items(), key=lambda item: item[1], reverse=True)
+    top = ranked[:TOP_CATEGORIES]
+    rest = round(sum(amount for _, amount in ranked[TOP_CATEGORIES:]), 2)
+    if rest:
+        top.append(("other", rest))
+    return top
+
+def chart_data(user_id, period, today=None):
+    # Everything drawn on the chart; built from rollups, plus the week's own
+    # expenses for its category split since rollups only split categories by month
+    today = today or date.today()
+    if period == "week":
+        start = today - timedelta(days=6)
+        months = rollups.months_between(start, today)
+    elif period == "month":
+        start = today.replace(day=1)
+        months = [today.strftime("%Y-%m")]
+    else:
+        start = date(today.year - 1, today.month, 1)
+        months = rollups.months_between(start, today)[1:]
+    profile = storage.get_profile(user_id, months)
+    if profile is None:
+        return None
+    totals = profile.get("rollups", {})
+
+    if period == "year":
+        labels = [date.fromisoformat(f"{month}-01").strftime("%b") for month in months]
+        series = [rollups.month_total(totals, month) for month in months]
+        categories = {}
+        for month in months:
+            for cat, amount in rollups.month_categories(totals, month).items():
+                categories[cat] = round(categories.get(cat, 0) + amount, 2)
+    else:
+        days = [start + timedelta(days=i) for i in range((today - start).days + 1)]
+        labels = [day.strftime("%a" if period == "week" else "%d") for day in days]
+        series = [rollups.day_total(totals, day) for day in days]
+        if period == "month":
+            categories = rollups.month_categories(totals, months[0])
+        else:
+            categories = {}
+            end = (today + timedelta(days=1)).isoformat()
+            for e in storage.iter_expenses(user_id, start.isoformat(), end):
+                cat = e.get("category", "misc")
+                categories[cat] = round(categories.get(cat, 0) + e["amount"], 2)
+
+    titles = {"week": "Last 7 days", "month": today.strftime("%B %Y"), "year": "Last 12 months"}
+    return {
+        "title": titles[period],
+        "currency": profile.get("currency", "USD"),
+        "labels": labels,
+        "series": series,
+        "categories": _top(categories),
+    }
+
+def digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+# -------------------- RENDERING --------------------
+
+def render(data):
+    # Runs in the chart process pool; returns PNG bytes
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, (trend, split) = plt.subplots(1, 2, figsize=(10, 4), gridspec_kw={"width_ratios": [3, 2]})
+    try:
+        trend.bar(range(len(data["series"])), data["series"], color="#4c72b0")
+        step = max(1, len(data["labels"]) // 12)
+        trend.set_xticks(range(0, len(data["labels"]), step))
+        trend.set_xticklabels(data["labels"][::step])
+        trend.set_ylabel(data["currency"])
+        trend.set_title(f"{data['title']}: {round(sum(data['series']), 2)} {data['currency']}")
+
+        if data["categories"]:
+            names = [name for name, _ in data["categories"]]
+            amounts = [amount for _, amount in data["categories"]]
+            split.pie(amounts, labels=names, autopct="%1.0f%%", startangle=90, textprops={"fontsize": 8})
+        split.set_title("By category")
+        split.axis("equal")
+
+        fig.tight_layout()
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=100)
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+async def render_png(data):
+    async with _get_slots():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), render, data)
+
+# -------------------- CACHE --------------------
+
+def cached_file_id(user_id, period, data_digest):
+    with _lock:
+        entry = _cache.get((str(user_id), period))
+        if entry is None or entry["digest"] != data_digest:
+            return None
+        _cache.move_to_end((str(user_id), period))
+        return entry["file_id"]
+
+def remember(user_id, period, data_digest, file_id):
+    with _lock:
+        _cache[(str(user_id), period)] = {"digest": data_digest, "file_id": file_id}
+        _cache.move_to_end((str(user_id), period))
+        while len(_cache) > CHART_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def close():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
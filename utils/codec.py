@@ -0,0 +1,80 @@
+import importlib.util
+import json
+import os
+import threading
+import zlib
+
+import msgpack
+
+from . import metrics
+
+# The plaintext inside every Fernet token. Payloads written before this module
+# are bare JSON; newer ones start with a format byte that JSON text can't start
+# with, so both read back transparently:
+#   0x01 msgpack    0x02 msgpack + zlib    0x03 msgpack + zstd
+MSGPACK, MSGPACK_ZLIB, MSGPACK_ZSTD = 1, 2, 3
+
+ZSTD_AVAILABLE = importlib.util.find_spec("zstandard") is not None
+if ZSTD_AVAILABLE:
+    import zstandard
+
+# "json" writes the old format (JSON inside base64 Fernet tokens) that releases
+# before this module can read. Set it and let every user be rewritten before
+# rolling back; files already in the new format stay unreadable to old releases
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "msgpack")
+# "zstd" (needs the zstandard package), "zlib" or "none"
+PAYLOAD_COMPRESSION = os.getenv("PAYLOAD_COMPRESSION", "zstd" if ZSTD_AVAILABLE else "zlib")
+# Smaller payloads (single journal records, small profiles) aren't worth compressing
+COMPRESS_MIN_BYTES = int(os.getenv("PAYLOAD_COMPRESS_MIN_BYTES", 512))
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 1
+
+# zstandard (de)compressors aren't thread-safe; every storage thread gets its own
+_local = threading.local()
+
+def _zstd():
+    if not hasattr(_local, "zstd"):
+        _local.zstd = (zstandard.ZstdCompressor(level=ZSTD_LEVEL), zstandard.ZstdDecompressor())
+    return _local.zstd
+
+def _compression():
+    if PAYLOAD_COMPRESSION == "zstd" and ZSTD_AVAILABLE:
+        return MSGPACK_ZSTD
+    if PAYLOAD_COMPRESSION in ("zstd", "zlib"):
+        return MSGPACK_ZLIB
+    return MSGPACK
+
+def encode(value):
+    # Any JSON-compatible value -> bytes for Fernet
+    if PAYLOAD_FORMAT == "json":
+        with metrics.timer("codec", "encode"):
+            return json.dumps(value).encode()
+    with metrics.timer("codec", "encode"):
+        raw = msgpack.packb(value, use_bin_type=True)
+    kind = _compression() if len(raw) >= COMPRESS_MIN_BYTES else MSGPACK
+    if kind == MSGPACK:
+        return bytes((MSGPACK,)) + raw
+    with metrics.timer("codec", "compress"):
+        if kind == MSGPACK_ZSTD:
+            packed = _zstd()[0].compress(raw)
+        else:
+            packed = zlib.compress(raw, ZLIB_LEVEL)
+    metrics.observe_size("payload_bytes", "uncompressed", len(raw))
+    return bytes((kind,)) + packed
+
+def decode(payload):
+    kind = payload[0] if payload else None
+    if kind not in (MSGPACK, MSGPACK_ZLIB, MSGPACK_ZSTD):
+        with metrics.timer("codec", "decode"):
+            return json.loads(payload)
+    raw = memoryview(payload)[1:]
+    if kind != MSGPACK:
+        with metrics.timer("codec", "decompress"):
+            if kind == MSGPACK_ZSTD:
+                if not ZSTD_AVAILABLE:
+                    raise ValueError("Payload is zstd-compressed but the zstandard package isn't installed")
+                raw = _zstd()[1].decompress(raw)
+            else:
+                raw = zlib.decompress(raw)
+    with metrics.timer("codec", "decode"):
+        return msgpack.unpackb(raw, raw=False)
@@ -1,21 +1,148 @@
-import requests
+import asyncio
+import json
+import os
+import time
+import httpx
+from . import metrics
+from .backends import atomic_write
 
-API_URL = "https://api.exchangerate.host/latest"
+# Point EXCHANGE_API_URL at a local stand-in server to run without the real API
+API_URL = os.getenv("EXCHANGE_API_URL", "https://api.exchangerate.host/latest")
+EXCHANGE_API_KEY = os.getenv("EXCHANGE_API_KEY")
+# Seconds a fetched rate table stays fresh
+RATES_TTL = float(os.getenv("RATES_TTL", 3600))
+# After a failed fetch, wait this long before trying the network again
+RATES_RETRY_AFTER = 60
+RATES_SNAPSHOT = os.path.join("data", "rates.json")
+HTTP_TIMEOUT = 10
 
-# Base is always USD
-rates_cache = {}
+class RateProvider:
+    # Base is always USD. The whole table is fetched at most once per TTL; callers
+    # get the cached table, a stale one while a refresh runs in the background,
+    # or the last snapshot persisted on disk if the API is unreachable.
+    # transport swaps the network for a stand-in, e.g. an httpx.MockTransport in tests
+    def __init__(self, url=API_URL, ttl=RATES_TTL, snapshot_path=RATES_SNAPSHOT, transport=None):
+        self.url = url
+        self.transport = transport
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self._rates = None
+        self._fetched_at = 0.0  # wall-clock time, so snapshots survive restarts
+        self._inflight = None
+        self._client = None
+        self._snapshot_checked = False
 
-def get_rate(target_currency):
-    target_currency = target_currency.upper()
-    if target_currency in rates_cache:
-        return rates_cache[target_currency]
-    res = requests.get(f"{API_URL}?base=USD")
-    data = res.json()
-    rate = data["rates"].get(target_currency, 1.0)
-    rates_cache[target_currency] = rate
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=HTTP_TIMEOUT,
+                transport=self.transport,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            )
+        return self._client
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[WARNING] Ignoring unreadable rates snapshot: {e}")
+            return None
+
+    def _save_snapshot(self, rates, fetched_at):
+        try:
+            atomic_write(self.snapshot_path, json.dumps({"fetched_at": fetched_at, "rates": rates}).encode())
+        except Exception as e:
+            print(f"[WARNING] Failed to persist rates snapshot: {e}")
+
+    @metrics.timed("currency", "fetch")
+    async def _fetch(self):
+        params = {"base": "USD"}
+        if EXCHANGE_API_KEY:
+            params["access_key"] = EXCHANGE_API_KEY
+        res = await self._get_client().get(self.url, params=params)
+        res.raise_for_status()
+        rates = res.json()["rates"]
+        rates["USD"] = 1.0
+        return rates
+
+    async def _refresh(self):
+        loop = asyncio.get_running_loop()
+        try:
+            rates = await self._fetch()
+        except Exception as e:
+            print(f"[WARNING] Exchange rate fetch failed: {e}")
+            metrics.increment("currency_stale_served_total", "fetch")
+            # Keep serving what we have and try the network again a bit later
+            self._fetched_at = time.time() - self.ttl + RATES_RETRY_AFTER
+            return self._rates
+        self._rates = rates
+        self._fetched_at = time.time()
+        await loop.run_in_executor(None, self._save_snapshot, rates, self._fetched_at)
+        return rates
+
+    def _start_refresh(self):
+        # Concurrent callers share one in-flight fetch
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._refresh())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return self._inflight
+
+    def _clear_inflight(self, task):
+        self._inflight = None
+
+    async def get_rates(self):
+        if not self._snapshot_checked:
+            self._snapshot_checked = True
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, self._load_snapshot)
+            if snapshot and self._rates is None:
+                self._rates = snapshot["rates"]
+                self._fetched_at = snapshot["fetched_at"]
+
+        if self._rates is not None:
+            if time.time() - self._fetched_at >= self.ttl:
+                self._start_refresh()
+            return self._rates
+
+        # Nothing cached yet: this is the only time a caller waits on the network.
+        # Shielded so one cancelled caller doesn't cancel the fetch for everyone else
+        rates = await asyncio.shield(self._start_refresh())
+        if rates is None:
+            raise RuntimeError("Exchange rates are unavailable")
+        return rates
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+provider = RateProvider()
+
+def _rate(rates, currency):
+    rate = rates.get(currency.upper())
+    if rate is None:
+        raise ValueError(f"Unknown currency: {currency}")
     return rate
 
-def convert(amount, from_currency, to_currency):
-    rate_from = get_rate(from_currency)
-    rate_to = get_rate(to_currency)
-    return amount / rate_from * rate_to
+async def get_rate(target_currency):
+    rates = await provider.get_rates()
+    return _rate(rates, target_currency)
+
+async def convert(amount, from_currency, to_currency):
+    rates = await provider.get_rates()
+    return amount / _rate(rates, from_currency) * _rate(rates, to_currency)
+
+async def convert_many(expenses, to_currency, default_currency="USD"):
+    # One rate table lookup for the whole list; expenses without their own
+    # "currency" are taken to be in default_currency
+    rates = await provider.get_rates()
+    to_rate = _rate(rates, to_currency)
+    converted = []
+    for e in expenses:
+        from_rate = _rate(rates, e.get("currency", default_currency))
+        converted.append({**e, "amount": round(e["amount"] / from_rate * to_rate, 2), "currency": to_currency.upper()})
+    return converted
+
+async def close():
+    await provider.close()
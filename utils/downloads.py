@@ -0,0 +1,34 @@
+import httpx
+
+# One pooled client for every file downloaded from Telegram (receipts, imports)
+CHUNK_SIZE = 64 * 1024
+
+_client = None
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=60, follow_redirects=True)
+    return _client
+
+async def stream_to(file, out, max_bytes, too_large, on_chunk=None):
+    # Streams a Telegram file into the binary file object out; raises
+    # ValueError(too_large) once more than max_bytes have arrived.
+    # Returns the number of bytes written
+    size = 0
+    async with _get_client().stream("GET", file.file_path) as res:
+        res.raise_for_status()
+        async for chunk in res.aiter_bytes(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(too_large)
+            if on_chunk is not None:
+                on_chunk(chunk)
+            out.write(chunk)
+    return size
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
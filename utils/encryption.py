@@ -1,8 +1,8 @@
-import base64
-import json
 from cryptography.fernet import Fernet, InvalidToken
 import os
 
+from .backends import decode_payload, encode_payload
+
 KEYS_DIR = "data/keys"
 DATA_DIR = "data"
 
@@ -31,14 +31,11 @@ def get_fernet_for_user(user_id: str) -> Fernet:
     return Fernet(key)
 
 def encrypt_data_for_user(data: dict, user_id: str) -> bytes:
-    fernet = get_fernet_for_user(user_id)
-    json_str = json.dumps(data)
-    return fernet.encrypt(json_str.encode())
+    # Same on-disk format as the storage backends (see utils/codec.py)
+    return encode_payload(get_fernet_for_user(user_id), data, binary=True)
 
 def decrypt_data_for_user(encrypted_bytes: bytes, user_id: str) -> dict:
-    fernet = get_fernet_for_user(user_id)
-    json_str = fernet.decrypt(encrypted_bytes).decode()
-    return json.loads(json_str)
+    return decode_payload(get_fernet_for_user(user_id), encrypted_bytes)
 
 def save_encrypted_file_for_user(data: dict, user_id: str):
     ensure_dirs()
@@ -0,0 +1,84 @@
+import csv
+import gzip
+import io
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+from . import storage
+
+CSV_FIELDS = ["date", "amount", "category", "description"]
+# Exports stay in memory up to this size, then spill over to a temp file on disk
+SPOOL_MAX_BYTES = int(os.getenv("EXPORT_SPOOL_MAX_BYTES", 1024 * 1024))
+WRITE_BATCH_ROWS = 1000
+
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def parse_export_args(args):
+    # "/export 2026-01-01 2026-03-31 food gz": both dates are inclusive, all parts optional
+    dates, category, compress = [], None, False
+    for arg in args:
+        if DATE_RE.fullmatch(arg):
+            dates.append(datetime.strptime(arg, "%Y-%m-%d").date())
+        elif arg.lower() in ("gz", "gzip"):
+            compress = True
+        elif category is None:
+            category = arg.lower()
+        else:
+            raise ValueError(f"Unexpected argument: {arg}")
+    if len(dates) > 2:
+        raise ValueError("At most two dates: start and end")
+    start = dates[0].isoformat() if dates else None
+    end = (dates[1] + timedelta(days=1)).isoformat() if len(dates) == 2 else None
+    return {"start": start, "end": end, "category": category, "compress": compress}
+
+def write_csv(rows, fileobj, compress=False):
+    # Rows are formatted into a small text buffer and written to fileobj (through
+    # gzip, if asked) as encoded bytes a batch at a time. TextIOWrapper can't wrap
+    # a SpooledTemporaryFile before Python 3.11, so the encoding is done here
+    raw = gzip.GzipFile(fileobj=fileobj, mode="wb") if compress else fileobj
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % WRITE_BATCH_ROWS == 0:
+            raw.write(buffer.getvalue().encode("utf-8"))
+            buffer.seek(0)
+            buffer.truncate()
+    raw.write(buffer.getvalue().encode("utf-8"))
+    if compress:
+        raw.close()  # writes the gzip trailer, doesn't close fileobj
+    return count
+
+def _tee(rows, observe):
+    for row in rows:
+        observe(row)
+        yield row
+
+def export_expenses(user_id, start=None, end=None, category=None, compress=False, observe=None):
+    # Returns (file positioned at 0, row count); the caller closes the file.
+    # observe, if given, is called with every row as it's written
+    report = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    rows = storage.iter_expenses(user_id, start, end, category)
+    if observe is not None:
+        rows = _tee(rows, observe)
+    try:
+        count = write_csv(rows, report, compress)
+    except BaseException:
+        report.close()
+        raise
+    report.seek(0)
+    return report, count
+
+def export_filename(start=None, end=None, category=None, compress=False):
+    parts = ["expenses"]
+    if start:
+        parts.append(start)
+    if end:
+        parts.append((datetime.fromisoformat(end) - timedelta(days=1)).date().isoformat())
+    if category:
+        parts.append(category)
+    return "_".join(parts) + (".csv.gz" if compress else ".csv")
@@ -0,0 +1,215 @@
+import csv
+import gzip
+import json
+import os
+import re
+import tempfile
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from . import downloads, storage
+
+# Rows parsed, deduped and written to storage per batch: one journal record
+# (or SQLite transaction) per batch instead of one save per expense
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 5000))
+# Telegram only lets bots download files up to 20 MB
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", 20 * 1024 * 1024))
+# Uploads stay in memory up to this size, then spill over to a temp file on disk
+SPOOL_MAX_BYTES = int(os.getenv("IMPORT_SPOOL_MAX_BYTES", 1024 * 1024))
+# Extra bank formats, a JSON object of name -> format like the ones below
+IMPORT_FORMATS_FILE = os.getenv("IMPORT_FORMATS_FILE")
+MAX_REPORTED_ERRORS = 5
+
+# A format maps CSV columns onto expense fields. date_format is a strptime pattern
+# (None for ISO dates); with spending_negative, debits are negative amounts and
+# credits are skipped; decimal_comma reads "1.234,56" amounts.
+FORMATS = {
+    # What /export writes
+    "expenses": {"date": "date", "amount": "amount", "category": "category", "description": "description"},
+    "bank_simple": {
+        "date": "Date", "amount": "Amount", "description": "Description",
+        "date_format": "%d/%m/%Y", "spending_negative": True,
+    },
+    "bank_debit_credit": {
+        "date": "Date", "amount": "Debit", "description": "Details", "category": "Category",
+        "date_format": "%d/%m/%Y",
+    },
+    "bank_eu": {
+        "date": "Buchungstag", "amount": "Betrag", "description": "Verwendungszweck",
+        "date_format": "%d.%m.%Y", "spending_negative": True, "decimal_comma": True, "delimiter": ";",
+    },
+}
+
+def _load_formats():
+    if not IMPORT_FORMATS_FILE:
+        return
+    try:
+        with open(IMPORT_FORMATS_FILE) as f:
+            FORMATS.update(json.load(f))
+    except Exception as e:
+        print(f"[WARNING] Ignoring unreadable import formats file: {e}")
+
+_load_formats()
+
+# Raised while reading a broken or mislabelled upload (bad gzip, wrong encoding, malformed CSV)
+READ_ERRORS = (OSError, UnicodeDecodeError, csv.Error)
+
+AMOUNT_JUNK_RE = re.compile(r"[^\d.,\-]")
+
+def parse_import_args(args):
+    # "/import" or "/import bank_simple"; without a name the format is picked from the header
+    if not args:
+        return None
+    name = args[0].lower()
+    if name not in FORMATS:
+        raise ValueError(f"Unknown format: {args[0]}")
+    return name
+
+def detect_format(header):
+    columns = set(header)
+    for name, spec in FORMATS.items():
+        if spec["date"] in columns and spec["amount"] in columns:
+            return name
+    return None
+
+def _parse_amount(raw, spec):
+    raw = AMOUNT_JUNK_RE.sub("", raw or "")
+    if not raw:
+        return None  # e.g. the empty Debit cell of a credit row
+    if spec.get("decimal_comma"):
+        raw = raw.replace(".", "").replace(",", ".")
+    else:
+        raw = raw.replace(",", "")
+    amount = float(raw)
+    if spec.get("spending_negative"):
+        if amount >= 0:
+            return None  # A credit, not spending
+        amount = -amount
+    return round(amount, 2) if amount > 0 else None
+
+def _parse_date(raw, spec):
+    raw = (raw or "").strip()
+    if spec.get("date_format"):
+        return datetime.strptime(raw, spec["date_format"]).isoformat()
+    return datetime.fromisoformat(raw).isoformat()
+
+def parse_row(row, spec):
+    # An expense dict, None for rows that aren't spending; raises ValueError on bad rows
+    amount = _parse_amount(row.get(spec["amount"]), spec)
+    if amount is None:
+        return None
+    expense = {"date": _parse_date(row.get(spec["date"]), spec), "amount": amount}
+    category = (row.get(spec["category"]) or "").strip().lower() if spec.get("category") else ""
+    expense["category"] = category or "misc"
+    description = (row.get(spec["description"]) or "").strip() if spec.get("description") else ""
+    if description:
+        expense["description"] = description
+    return expense
+
+def _decoded_lines(raw):
+    # Text lines, line endings kept, from a binary file. Decoded here rather than
+    # with io.TextIOWrapper, which can't wrap a SpooledTemporaryFile before 3.11
+    for number, line in enumerate(raw):
+        text = line.decode("utf-8")
+        yield text.lstrip("\ufeff") if number == 0 else text
+
+def _key(expense):
+    return (expense["date"], expense["amount"], expense.get("category", "misc"), expense.get("description", ""))
+
+class Import:
+    # One upload being imported. Rows are read lazily from the (spooled) file a
+    # batch at a time, so memory holds one batch plus the dedupe keys of the
+    # months the file touches, never the whole file.
+    # A row is a duplicate while the ledger already holds as many identical
+    # expenses as the file has had so far, so re-importing a file adds nothing
+    # but two genuinely identical rows in a new file are both kept.
+    def __init__(self, user_id, fileobj, format_name=None):
+        self.user_id = str(user_id)
+        self.file = fileobj
+        self.format_name = format_name
+        self.spec = None
+        self.rows = None
+        self.imported = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.errors = []
+        self.months = set()
+        self._stored = {}  # "YYYY-MM" -> Counter of keys already in the ledger
+        self._counts = Counter()  # keys seen in the file so far
+
+    def open(self):
+        # Runs on the storage pool; raises ValueError when the header fits no format
+        self.file.seek(0)
+        raw = self.file
+        if raw.read(2) == b"\x1f\x8b":
+            raw.seek(0)
+            raw = gzip.GzipFile(fileobj=self.file, mode="rb")
+        else:
+            raw.seek(0)
+        lines = _decoded_lines(raw)
+        first = next(lines, "")
+        if self.format_name is None:
+            delimiter = ";" if first.count(";") > first.count(",") else ","
+        else:
+            delimiter = FORMATS[self.format_name].get("delimiter", ",")
+        header = next(csv.reader([first], delimiter=delimiter), [])
+        header = [column.strip() for column in header]
+        name = self.format_name or detect_format(header)
+        if name is None or FORMATS[name]["date"] not in header or FORMATS[name]["amount"] not in header:
+            raise ValueError(f"Unrecognised columns: {', '.join(header) or 'none'}")
+        self.format_name = name
+        self.spec = FORMATS[name]
+        self.rows = csv.DictReader(lines, fieldnames=header, delimiter=self.spec.get("delimiter", delimiter))
+
+    def _stored_for(self, month):
+        stored = self._stored.get(month)
+        if stored is None:
+            # Read once per month the file touches; indexed backends read just that month
+            start = date.fromisoformat(f"{month}-01")
+            end = (start + timedelta(days=32)).replace(day=1)
+            stored = self._stored[month] = Counter(
+                _key(e) for e in storage.iter_expenses(self.user_id, start.isoformat(), end.isoformat())
+            )
+        return stored
+
+    def next_batch(self):
+        # Runs on the storage pool; up to IMPORT_BATCH_SIZE new expenses, [] at the end
+        batch = []
+        for row in self.rows:
+            try:
+                expense = parse_row(row, self.spec)
+            except (ValueError, TypeError) as e:
+                self.skipped += 1
+                if len(self.errors) < MAX_REPORTED_ERRORS:
+                    # +1 for the header, which was read before the DictReader
+                    self.errors.append(f"line {self.rows.line_num + 1}: {e}")
+                continue
+            if expense is None:
+                self.skipped += 1
+                continue
+            month = expense["date"][:7]
+            key = _key(expense)
+            self._counts[key] += 1
+            if self._counts[key] <= self._stored_for(month)[key]:
+                self.duplicates += 1
+                continue
+            self.months.add(month)
+            batch.append(expense)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                break
+        return batch
+
+    def close(self):
+        self.file.close()
+
+async def download(file):
+    # Streams the upload into a spooled temp file; the caller closes it
+    upload = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        await downloads.stream_to(
+            file, upload, IMPORT_MAX_BYTES, f"File is larger than {IMPORT_MAX_BYTES // (1024 * 1024)} MB",
+        )
+    except BaseException:
+        upload.close()
+        raise
+    return upload
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from telegram import Update
+from telegram.ext import Application, ContextTypes, ConversationHandler
+from telegram.request import HTTPXRequest
+from . import metrics, storage
+
+# Prometheus-style text endpoint on METRICS_HOST:METRICS_PORT; 0 leaves it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# Telegram user ids allowed to run /stats
+ADMIN_IDS = {int(uid) for uid in os.getenv("ADMIN_IDS", "").split(",") if uid.strip()}
+# Updates slower than this many ms get their sampled stacks printed; 0 leaves the profiler off
+PROFILE_SLOW_UPDATES_MS = float(os.getenv("PROFILE_SLOW_UPDATES_MS", 0))
+PROFILE_INTERVAL = 0.005
+PROFILE_STACK_DEPTH = 12
+
+# -------------------- TELEGRAM API --------------------
+
+class InstrumentedRequest(HTTPXRequest):
+    # Times every Bot API call by method name (sendMessage, sendDocument, ...)
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        with metrics.timer("telegram_api", endpoint):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        metrics.observe_size("telegram_api_response_bytes", endpoint, len(payload))
+        return code, payload
+
+# -------------------- SLOW UPDATE PROFILER --------------------
+
+class SlowUpdateSampler:
+    # Samples the event loop thread's stack while handlers run. When one turns out
+    # slow, the stacks seen during its run show what held up the loop.
+    def __init__(self, threshold_ms, interval=PROFILE_INTERVAL, max_samples=20000):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.loop_thread = threading.get_ident()
+        self.samples = deque(maxlen=max_samples)  # (seq, stack)
+        self.seq = 0
+        self.active = 0
+        threading.Thread(target=self._run, name="slow-update-sampler", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < PROFILE_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+                frame = frame.f_back
+            self.samples.append((self.seq, tuple(stack)))
+            self.seq += 1
+
+    def start(self):
+        self.active += 1
+        return self.seq
+
+    def finish(self, name, token, elapsed):
+        self.active -= 1
+        if elapsed < self.threshold:
+            return
+        stacks = Counter(stack for seq, stack in list(self.samples) if seq >= token)
+        print(f"[SLOW] {name} took {elapsed * 1000:.0f}ms, {sum(stacks.values())} samples")
+        for stack, hits in stacks.most_common(3):
+            print(f"  {hits} samples:\n    " + "\n    ".join(stack))
+
+_sampler = None
+_server = None
+
+# -------------------- HANDLERS --------------------
+
+def _wrap(callback):
+    if getattr(callback, "_instrumented", False):
+        return callback
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = _sampler.start() if _sampler else None
+        started = time.perf_counter()
+        try:
+            with metrics.timer("handler", name):
+                return await callback(update, context)
+        finally:
+            if _sampler:
+                _sampler.finish(name, token, time.perf_counter() - started)
+
+    wrapper._instrumented = True
+    return wrapper
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = handler.entry_points + handler.fallbacks
+        for state_handlers in handler.states.values():
+            nested += state_handlers
+        for inner in nested:
+            _instrument_handler(inner)
+    elif hasattr(handler, "callback"):
+        handler.callback = _wrap(handler.callback)
+
+def instrument_application(app: Application):
+    # Call after every handler is registered
+    global _sampler
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+    if PROFILE_SLOW_UPDATES_MS and _sampler is None:
+        # Built here, on the thread that will run the event loop
+        _sampler = SlowUpdateSampler(PROFILE_SLOW_UPDATES_MS)
+
+# -------------------- EXPORT --------------------
+
+def render_metrics():
+    lines = [metrics.render_prometheus().rstrip("\n")]
+    for key, value in sorted(storage.cache_stats.items()):
+        lines.append(f"expense_bot_storage_cache_{key}_total {value}")
+    return "\n".join(lines) + "\n"
+
+async def _serve_metrics(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        body = render_metrics().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    global _server
+    if not METRICS_PORT or _server is not None:
+        return
+    _server = await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+    print(f"[INFO] Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    histograms, counters = metrics.snapshot()
+    lines = ["📈 Stats (count, p50, p99):"]
+    for (name, label), h in sorted(histograms.items()):
+        if name.endswith("_seconds"):
+            lines.append(f"{name[:-8]}.{label}: {h['count']}, {h['p50'] * 1000:g}ms, {h['p99'] * 1000:g}ms")
+    errors = {key: value for key, value in counters.items() if key[0].endswith("_errors_total")}
+    for (name, label), value in sorted(errors.items()):
+        lines.append(f"⚠️ {name[:-13]}.{label} errors: {value}")
+    cache = storage.cache_stats
+    lines.append(f"cache: {cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions")
+    await update.message.reply_text("\n".join(lines))
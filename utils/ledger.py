@@ -0,0 +1,129 @@
+import calendar
+from array import array
+from datetime import date
+
+import numpy as np
+
+# Columnar form of a list of expenses for analytics over long histories: one
+# float64 amount, one int64 timestamp (seconds since the epoch, dates taken as
+# naive wall-clock time like everywhere else) and one int32 category code per
+# expense, about 20 bytes each against several hundred for a dict with an ISO
+# string. Descriptions and other extras aren't kept; this is for aggregating,
+# the stored expenses stay the source of truth.
+
+def _day_epoch(day, cache):
+    epoch = cache.get(day)
+    if epoch is None:
+        epoch = cache[day] = calendar.timegm(date.fromisoformat(day).timetuple())
+    return epoch
+
+def to_epoch(stamp, cache=None):
+    # "2026-10-17" or "2026-10-17T20:01:02.123" -> int seconds. Only the time of
+    # day is parsed per call; each distinct day is parsed once per cache
+    cache = {} if cache is None else cache
+    seconds = _day_epoch(stamp[:10], cache)
+    if len(stamp) >= 19:
+        seconds += int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60 + int(stamp[17:19])
+    return seconds
+
+class LedgerBuilder:
+    # Collects columns one expense at a time, e.g. while the same rows stream into a CSV
+    def __init__(self):
+        self.amounts, self.stamps, self.codes = array("d"), array("q"), array("i")
+        self.categories = []
+        self._lookup, self._days = {}, {}
+
+    def add(self, expense):
+        category = expense.get("category", "misc")
+        code = self._lookup.get(category)
+        if code is None:
+            code = self._lookup[category] = len(self.categories)
+            self.categories.append(category)
+        self.amounts.append(expense["amount"])
+        self.stamps.append(to_epoch(expense["date"], self._days))
+        self.codes.append(code)
+
+    def build(self):
+        return Ledger(
+            np.frombuffer(self.amounts, dtype=np.float64),
+            np.frombuffer(self.stamps, dtype=np.int64),
+            np.frombuffer(self.codes, dtype=np.int32),
+            self.categories,
+        )
+
+class Ledger:
+    def __init__(self, amounts=None, stamps=None, codes=None, categories=None):
+        self.amounts = np.asarray(amounts if amounts is not None else [], dtype=np.float64)
+        self.stamps = np.asarray(stamps if stamps is not None else [], dtype=np.int64)
+        self.codes = np.asarray(codes if codes is not None else [], dtype=np.int32)
+        self.categories = list(categories or [])
+
+    @classmethod
+    def from_expenses(cls, expenses):
+        builder = LedgerBuilder()
+        for e in expenses:
+            builder.add(e)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.amounts)
+
+    @property
+    def nbytes(self):
+        return self.amounts.nbytes + self.stamps.nbytes + self.codes.nbytes
+
+    def _mask(self, start=None, end=None, category=None):
+        # start is inclusive and end exclusive, ISO date or datetime strings like iter_expenses
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.stamps >= to_epoch(start)
+        if end is not None:
+            mask &= self.stamps < to_epoch(end)
+        if category is not None:
+            if category not in self.categories:
+                return np.zeros(len(self), dtype=bool)
+            mask &= self.codes == self.categories.index(category)
+        return mask
+
+    def total(self, start=None, end=None, category=None):
+        return round(float(self.amounts[self._mask(start, end, category)].sum()), 2)
+
+    def by_category(self, start=None, end=None):
+        mask = self._mask(start, end)
+        sums = np.bincount(self.codes[mask], weights=self.amounts[mask], minlength=len(self.categories))
+        counts = np.bincount(self.codes[mask], minlength=len(self.categories))
+        return {cat: round(float(sums[i]), 2) for i, cat in enumerate(self.categories) if counts[i]}
+
+    def _day_sums(self, mask=None):
+        # (days as datetime64[D], totals) for every day with spending. Days are
+        # binned densely from the earliest one, so there's no sort over the rows
+        stamps = self.stamps if mask is None else self.stamps[mask]
+        amounts = self.amounts if mask is None else self.amounts[mask]
+        if not len(stamps):
+            return np.array([], dtype="datetime64[D]"), np.array([])
+        days = stamps // 86400
+        first = days.min()
+        offsets = days - first
+        sums = np.bincount(offsets, weights=amounts)
+        present = np.flatnonzero(np.bincount(offsets))
+        return (present + first).astype("datetime64[D]"), sums[present]
+
+    def by_day(self, start=None, end=None):
+        # {"2026-10-17": total}
+        days, sums = self._day_sums(self._mask(start, end))
+        return {str(day): round(float(total), 2) for day, total in zip(days, sums)}
+
+    def by_month(self, start=None, end=None):
+        # {"2026-10": total}; grouped from the per-day totals, which are few
+        days, sums = self._day_sums(self._mask(start, end))
+        months, index = np.unique(days.astype("datetime64[M]"), return_inverse=True)
+        totals = np.bincount(index, weights=sums, minlength=len(months))
+        return {str(month): round(float(total), 2) for month, total in zip(months, totals)}
+
+def summary_lines(ledger, currency=None):
+    # Total plus per-category lines, largest first; used in report emails
+    suffix = f" {currency}" if currency else ""
+    categories = sorted(ledger.by_category().items(), key=lambda item: item[1], reverse=True)
+    lines = [f"Total: {ledger.total():.2f}{suffix}"]
+    lines += [f"  {cat}: {amount:.2f}{suffix}" for cat, amount in categories]
+    return lines
@@ -1,34 +1,184 @@
+import asyncio
 import smtplib
-import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
-from datetime import datetime
 import os
+from . import export, ledger, metrics
 
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 
-CSV_DIR = "csv_reports"
-os.makedirs(CSV_DIR, exist_ok=True)
+# Point these at a local stand-in (e.g. SMTP_HOST=localhost SMTP_PORT=8025 SMTP_SSL=0) for testing
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
+SMTP_SSL = os.getenv("SMTP_SSL", "1") != "0"
+# Logged-in SMTP connections kept open, one per sender thread
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 3))
+# Rendered reports waiting for a sender; rendering pauses while this is full
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 100))
+# Threads rendering report CSVs, kept apart from the storage pool so chat traffic isn't starved
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", 2))
+MAIL_ATTEMPTS = 3
+MAIL_BACKOFF = 2  # seconds, doubled after every failed attempt
 
-def export_csv(user_id, expenses):
-    path = os.path.join(CSV_DIR, f"{user_id}_report.csv")
-    with open(path, "w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=["date", "amount", "category"])
-        writer.writeheader()
-        for e in expenses:
-            writer.writerow({"date": e["date"], "amount": e["amount"], "category": e["category"]})
-    return path
+_render_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
 
-def send_email(recipient, file_path):
+def build_message(recipient, report, filename, summary=None):
     msg = EmailMessage()
     msg['Subject'] = 'Your Monthly Expense Report'
     msg['From'] = EMAIL_ADDRESS
     msg['To'] = recipient
-    msg.set_content('Attached is your monthly expense report.')
+    body = 'Attached is your monthly expense report.'
+    if summary:
+        body += '\n\n' + summary
+    msg.set_content(body)
 
-    with open(file_path, 'rb') as f:
-        msg.add_attachment(f.read(), maintype='application', subtype='octet-stream', filename=os.path.basename(file_path))
+    report.seek(0)
+    msg.add_attachment(report.read(), maintype='application', subtype='octet-stream', filename=filename)
+    return msg
 
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+def _is_transient(error):
+    # SMTPException subclasses OSError, so the specific cases have to come first
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, OSError)
+
+class SmtpPool:
+    # Each sender thread logs in once and reuses its connection for every message
+    def __init__(self, size=SMTP_POOL_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="smtp")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if SMTP_SSL:
+            smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30)
+        else:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        if EMAIL_ADDRESS and EMAIL_PASSWORD:
+            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        with self._lock:
+            self._connections.append(smtp)
+        self._local.smtp = smtp
+        return smtp
+
+    @metrics.timed("smtp", "send")
+    def _send(self, recipient, report, filename, summary=None):
+        msg = build_message(recipient, report, filename, summary)
+        smtp = getattr(self._local, "smtp", None) or self._connect()
+        try:
+            try:
+                smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Servers drop idle connections; log in again and resend once
+                self._discard(smtp)
+                smtp = self._connect()
+                smtp.send_message(msg)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            raise  # The server answered, so the connection is still good
+        except OSError:
+            self._discard(smtp)
+            raise
+
+    def _discard(self, smtp):
+        # Closes a broken connection's socket instead of leaking it
+        if getattr(self._local, "smtp", None) is smtp:
+            self._local.smtp = None
+        with self._lock:
+            if smtp in self._connections:
+                self._connections.remove(smtp)
+        try:
+            smtp.close()
+        except Exception:
+            pass
+
+    async def send(self, recipient, report, filename, summary=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._send, recipient, report, filename, summary)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for smtp in self._connections:
+                try:
+                    smtp.quit()
+                except Exception:
+                    pass
+            self._connections.clear()
+
+class MailQueue:
+    # Bounded queue of rendered reports drained by SMTP_POOL_SIZE sender tasks
+    def __init__(self, pool=None, workers=SMTP_POOL_SIZE, maxsize=MAIL_QUEUE_SIZE):
+        self.pool = pool or SmtpPool(workers)
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._queue = asyncio.Queue(self.maxsize)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, recipient, report, filename, on_sent=None, summary=None):
+        # Takes ownership of report and closes it once delivered or given up on
+        self.start()
+        await self._queue.put((recipient, report, filename, summary, on_sent))
+
+    async def _worker(self):
+        while True:
+            recipient, report, filename, summary, on_sent = await self._queue.get()
+            try:
+                if await self._deliver(recipient, report, filename, summary) and on_sent is not None:
+                    await on_sent()
+            except Exception as e:
+                print(f"[ERROR] Mail callback failed for {recipient}: {e}")
+            finally:
+                report.close()
+                self._queue.task_done()
+
+    async def _deliver(self, recipient, report, filename, summary=None):
+        for attempt in range(MAIL_ATTEMPTS):
+            try:
+                await self.pool.send(recipient, report, filename, summary)
+                return True
+            except Exception as e:
+                if not _is_transient(e) or attempt == MAIL_ATTEMPTS - 1:
+                    print(f"[ERROR] Failed to send report to {recipient}: {e}")
+                    return False
+                await asyncio.sleep(MAIL_BACKOFF * 2 ** attempt)
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.get_running_loop().run_in_executor(None, self.pool.close)
+
+mail_queue = MailQueue()
+
+def _render(user_id, start, end, currency):
+    # One pass over the month: rows stream into the CSV while their amounts,
+    # dates and categories are collected as columns for the summary
+    builder = ledger.LedgerBuilder()
+    report, count = export.export_expenses(user_id, start, end, observe=builder.add)
+    summary = "\n".join(ledger.summary_lines(builder.build(), currency)) if count else None
+    return report, count, summary
+
+@metrics.timed("report", "render")
+async def render_report(user_id, start=None, end=None, currency=None):
+    # Returns (report file, row count, summary text for the email body)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_render_executor, _render, user_id, start, end, currency)
+
+async def close():
+    await mail_queue.close()
+    _render_executor.shutdown(wait=False)
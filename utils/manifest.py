@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+
+from . import metrics
+from .backends import append_journal, atomic_write
+
+class JournaledIndex:
+    # A small {user_id: entry} map kept in memory and stored as plain JSON.
+    # Changes are appended to a journal next to the snapshot and folded in once
+    # the journal outgrows the snapshot, so a write never rewrites every entry.
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self._entries = None
+        self._pending = {}  # user_id -> entry changed since the last flush
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.journal_path)
+
+    def _read(self):
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                entries = json.load(f)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # A line torn by a crash
+                    for user_id, entry in record.items():
+                        entries.setdefault(user_id, {}).update(entry)
+        return entries
+
+    def load(self, rebuild):
+        # rebuild() returns {user_id: entry}; it runs only when nothing is on disk yet
+        with self._lock:
+            if self._entries is not None:
+                return
+            if self.exists():
+                with metrics.timer("manifest", "load"):
+                    self._entries = self._read()
+                return
+            print(f"[INFO] Building {os.path.basename(self.path)}, this happens once")
+            self._entries = rebuild()
+            self._write_snapshot()
+
+    def loaded(self):
+        return self._entries is not None
+
+    def entries(self):
+        with self._lock:
+            return {user_id: dict(entry) for user_id, entry in self._entries.items()}
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(str(user_id))
+            return dict(entry) if entry is not None else None
+
+    def _new_entry(self, user_id):
+        return {}
+
+    def update(self, user_id, increment=None, **fields):
+        # Sets fields (and adds one to the increment field) on the user's entry.
+        # Returns whether the user is new; new users are written out right away
+        # so a crash before the next flush can't lose them
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            is_new = entry is None
+            if is_new:
+                entry = self._entries[user_id] = self._new_entry(user_id)
+            entry.update(fields)
+            if increment:
+                entry[increment] = entry.get(increment, 0) + 1
+            self._pending[user_id] = entry
+        if is_new:
+            self.flush()
+        return is_new
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                record = {user_id: dict(entry) for user_id, entry in self._pending.items()}
+                self._pending = {}
+            try:
+                append_journal(self.journal_path, json.dumps(record).encode())
+            except Exception as e:
+                print(f"[ERROR] Failed to write {os.path.basename(self.path)}: {e}")
+                with self._lock:
+                    for user_id, entry in record.items():
+                        self._pending.setdefault(user_id, entry)
+                return
+            snapshot_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if os.path.getsize(self.journal_path) > max(snapshot_size, 64 * 1024):
+                self._write_snapshot()
+
+    def _write_snapshot(self):
+        with self._lock:
+            payload = json.dumps(self._entries).encode()
+        try:
+            atomic_write(self.path, payload)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        except Exception as e:
+            print(f"[ERROR] Failed to compact {os.path.basename(self.path)}: {e}")
+
+class UserManifest(JournaledIndex):
+    # Fleet-wide jobs enumerate users from this instead of listing and decrypting
+    # every user's files. It holds no amounts, emails or PINs:
+    #   {"chat_id": 12345, "timezone": null, "email": true,
+    #    "active": "2026-10-17T20:01:02", "last_expense": "2026-10-17", "version": 42}
+    # "version" goes up on every ledger write.
+    def _new_entry(self, user_id):
+        return {"chat_id": int(user_id), "version": 0}
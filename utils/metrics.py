@@ -0,0 +1,117 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process latency histograms, size histograms and counters, rendered in the
+# Prometheus text format. Safe to record from the event loop and worker threads.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_lock = threading.Lock()
+_histograms = {}  # (name, label) -> Histogram
+_counters = {}  # (name, label) -> int
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+def _histogram(name, label, buckets):
+    key = (name, label)
+    hist = _histograms.get(key)
+    if hist is None:
+        hist = _histograms[key] = Histogram(buckets)
+    return hist
+
+def observe_latency(name, label, seconds):
+    with _lock:
+        _histogram(name, label, LATENCY_BUCKETS).observe(seconds)
+
+def observe_size(name, label, size):
+    with _lock:
+        _histogram(name, label, SIZE_BUCKETS).observe(size)
+
+def increment(name, label, amount=1):
+    with _lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + amount
+
+@contextmanager
+def timer(name, label):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(f"{name}_errors_total", label)
+        raise
+    finally:
+        observe_latency(f"{name}_seconds", label, time.perf_counter() - started)
+
+def timed(name, label=None):
+    # Decorator for sync and async functions; the label defaults to the function name
+    def decorate(func):
+        op = label or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(name, op):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, op):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def snapshot():
+    with _lock:
+        histograms = {
+            key: {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+            for key, h in _histograms.items()
+        }
+        counters = dict(_counters)
+    return histograms, counters
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        for (name, label), hist in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append(f'expense_bot_{name}_bucket{{op="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'expense_bot_{name}_bucket{{op="{label}",le="+Inf"}} {hist.count}')
+            lines.append(f'expense_bot_{name}_sum{{op="{label}"}} {hist.sum}')
+            lines.append(f'expense_bot_{name}_count{{op="{label}"}} {hist.count}')
+        for (name, label), value in sorted(_counters.items()):
+            lines.append(f'expense_bot_{name}{{op="{label}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
@@ -0,0 +1,44 @@
+import argparse
+
+from . import storage
+
+# One-shot copy of the file-based layouts under data/ into SQLite.
+# Run with: python -m utils.migrate [--source partitioned|json] [--db data/expenses.db]
+# Keys stay where they are, the SQLite backend encrypts with the same per-user keys.
+
+def migrate(db_path=None, batch_size=200, source_kind="partitioned"):
+    # Read-only: the partitioned source reads users still in the one-file layout
+    # as they are, without splitting them up, so the source is never modified
+    source = storage.create_backend(source_kind)
+    target = storage.create_backend("sqlite", sqlite_path=db_path)
+    migrated = 0
+    batch = []
+    try:
+        for user_id in source.list_users():
+            data = source.load_readonly(user_id)
+            if data is None:
+                print(f"[WARNING] Skipping unreadable data for user {user_id}")
+                continue
+            batch.append((user_id, data))
+            if len(batch) >= batch_size:
+                if not target.save_many(batch):
+                    raise RuntimeError("Migration aborted, see the error above")
+                migrated += len(batch)
+                batch = []
+        if batch:
+            if not target.save_many(batch):
+                raise RuntimeError("Migration aborted, see the error above")
+            migrated += len(batch)
+    finally:
+        target.close()
+    return migrated
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Copy encrypted user files into SQLite")
+    arg_parser.add_argument("--source", choices=("partitioned", "json"), default="partitioned",
+                            help="Layout to read from")
+    arg_parser.add_argument("--db", default=storage.SQLITE_PATH, help="SQLite database to write")
+    arg_parser.add_argument("--batch-size", type=int, default=200, help="Users per transaction")
+    args = arg_parser.parse_args()
+    count = migrate(args.db, args.batch_size, args.source)
+    print(f"Migrated {count} users to {args.db}. Set STORAGE_BACKEND=sqlite to use it.")
@@ -1,11 +1,67 @@
 import re
+from datetime import datetime
+
+# Examples: "spent 50 on food", "bought lunch 12", "2026-01-03 taxi 18 airport".
+# A message may hold several expenses, one per line (or separated by ";" or ",").
+# A comma with digits on both sides is part of an amount: "1,200" or "12,50".
+COMMAND_RE = re.compile(r"^\s*/\w+(@\w+)?")
+LINE_SPLIT_RE = re.compile(r"[\n;]|(?<!\d),|,(?!\d)")
+DATE_RE = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+AMOUNT_RE = re.compile(r"\d{1,3}(,\d{3})+(\.\d{1,2})?|\d+([.,]\d{1,2})?")
+_THOUSANDS_RE = re.compile(r"\d{1,3}(,\d{3})+")
+WORD_RE = re.compile(r"[^\W\d_][\w'-]*")
+VERBS = {"spent", "paid", "bought"}
+LINKERS = {"on", "for"}
+
+def parse_amount(text):
+    # "1,200" and "1,200.50" use thousands separators, "12,50" a decimal comma
+    if "." in text or _THOUSANDS_RE.fullmatch(text):
+        return float(text.replace(",", ""))
+    return float(text.replace(",", "."))
+
+def parse_expense_line(line):
+    date = None
+    match = DATE_RE.search(line)
+    if match:
+        try:
+            date = datetime.strptime(match.group(1), "%Y-%m-%d")
+        except ValueError:
+            return None  # Looks like a date but isn't one; don't read its year as the amount
+        line = line[:match.start()] + " " + line[match.end():]
+
+    match = AMOUNT_RE.search(line)
+    if not match or line[:match.start()].endswith("-"):
+        return None  # No amount, or a negative one
+    before = [w for w in WORD_RE.findall(line[:match.start()]) if w.lower() not in VERBS]
+    after = WORD_RE.findall(line[match.end():])
+    linked = bool(after) and after[0].lower() in LINKERS
+    if linked:
+        after = after[1:]
+
+    # "50 on food" names the category after the amount, "lunch 12" before it
+    if after and (linked or not before):
+        category, rest = after[0], before + after[1:]
+    elif before:
+        category, rest = before[0], before[1:] + after
+    else:
+        category, rest = "misc", []
+
+    expense = {"amount": parse_amount(match.group(0)), "category": category.lower()}
+    if rest:
+        expense["description"] = " ".join(rest)
+    if date:
+        expense["date"] = date.isoformat()
+    return expense
+
+def parse_expenses(text):
+    text = COMMAND_RE.sub("", text or "")
+    expenses = []
+    for line in LINE_SPLIT_RE.split(text):
+        parsed = parse_expense_line(line)
+        if parsed:
+            expenses.append(parsed)
+    return expenses
 
 def parse_expense_message(text):
-    # Example: "spent 50 on food", "bought lunch 12"
-    pattern = re.compile(r"(?i)(spent|paid|bought)?\s*(\d+(\.\d{1,2})?)\s*(on|for)?\s*(\w+)?")
-    match = pattern.search(text)
-    if not match:
-        return None
-    amount = float(match.group(2))
-    category = match.group(5) or "misc"
-    return {"amount": amount, "category": category.lower()}
+    expenses = parse_expenses(text)
+    return expenses[0] if expenses else None
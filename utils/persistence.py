@@ -0,0 +1,164 @@
+import asyncio
+import json
+import os
+from copy import deepcopy
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from . import sharding
+from .backends import atomic_write
+
+# Conversation states and per-user/per-chat session data, kept apart from the
+# encrypted ledgers in one small plain-JSON file per shard. Nothing secret goes
+# in here: PINs, amounts and emails only ever reach utils/storage.
+PERSISTENCE_PATH = os.path.join(
+    "data", "sessions.json" if sharding.SHARD_COUNT == 1 else f"sessions.{sharding.SHARD_INDEX}.json",
+)
+# Seconds between PTB pushing changed user/chat data and conversations to us
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 30))
+# Changes arriving within this many seconds of each other are written together
+PERSISTENCE_COALESCE = 1.0
+
+class SessionPersistence(BasePersistence):
+    # Holds everything in memory; every update only marks the store dirty and a
+    # single delayed write, done off the event loop, picks up all of them.
+    # flush() (called by PTB at shutdown) writes whatever is still pending.
+    def __init__(self, path=PERSISTENCE_PATH, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self._data = None
+        self._conversations = {}  # name -> {key tuple: state}
+        self._dirty = False
+        self._pending = None
+        self._write_lock = None
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        data = {"conversations": {}, "user_data": {}, "chat_data": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data.update(json.load(f))
+            except Exception as e:
+                print(f"[WARNING] Ignoring unreadable session store: {e}")
+        # Stored as [key, state] pairs, since JSON objects can't have tuple keys
+        self._conversations = {
+            name: {tuple(key): state for key, state in entries} for name, entries in data["conversations"].items()
+        }
+        self._data = data
+        return data
+
+    def _snapshot(self):
+        self._data["conversations"] = {
+            name: [[list(key), state] for key, state in entries.items()]
+            for name, entries in self._conversations.items()
+        }
+        return json.dumps(self._data, separators=(",", ":")).encode()
+
+    async def _write_soon(self):
+        await asyncio.sleep(PERSISTENCE_COALESCE)
+        self._pending = None
+        await self._write()
+
+    async def _write(self):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        # One write at a time, so an older snapshot never lands after a newer one
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            payload = self._snapshot()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, atomic_write, self.path, payload)
+            except Exception as e:
+                print(f"[ERROR] Failed to write the session store: {e}")
+                self._dirty = True
+
+    def _changed(self):
+        self._dirty = True
+        if self._pending is None:
+            self._pending = asyncio.get_running_loop().create_task(self._write_soon())
+
+    # -------------------- READS --------------------
+
+    async def get_user_data(self):
+        return {int(k): v for k, v in deepcopy(self._load()["user_data"]).items()}
+
+    async def get_chat_data(self):
+        return {int(k): v for k, v in deepcopy(self._load()["chat_data"]).items()}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        self._load()
+        return dict(self._conversations.get(name, {}))
+
+    # -------------------- WRITES --------------------
+
+    async def update_conversation(self, name, key, new_state):
+        self._load()
+        entries = self._conversations.setdefault(name, {})
+        key = tuple(key)
+        if new_state is None:
+            if entries.pop(key, None) is None:
+                return
+        elif entries.get(key) == new_state:
+            return
+        else:
+            entries[key] = new_state
+        self._changed()
+
+    async def update_user_data(self, user_id, data):
+        self._update("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._update("chat_data", chat_id, data)
+
+    def _update(self, kind, key, data):
+        store = self._load()[kind]
+        key = str(key)
+        if store.get(key) == data:
+            return
+        if data:
+            store[key] = deepcopy(data)
+        elif store.pop(key, None) is None:
+            return
+        self._changed()
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        if self._load()["user_data"].pop(str(user_id), None) is not None:
+            self._changed()
+
+    async def drop_chat_data(self, chat_id):
+        if self._load()["chat_data"].pop(str(chat_id), None) is not None:
+            self._changed()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        await self._write()
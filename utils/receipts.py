@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from PIL import Image, ImageOps
+
+from . import downloads, storage
+
+# Receipts are stored once per distinct image, named by the SHA-256 of the bytes
+# Telegram sent: receipts/ab/abcdef....jpg plus a .thumb.jpg next to it.
+RECEIPTS_DIR = "receipts"
+# Stored copies are re-encoded down to this many pixels on the long side
+RECEIPT_MAX_SIDE = int(os.getenv("RECEIPT_MAX_SIDE", 1600))
+RECEIPT_THUMB_SIDE = int(os.getenv("RECEIPT_THUMB_SIDE", 320))
+RECEIPT_QUALITY = int(os.getenv("RECEIPT_QUALITY", 80))
+# Uploads larger than this are refused before (or while) downloading
+RECEIPT_MAX_BYTES = int(os.getenv("RECEIPT_MAX_BYTES", 10 * 1024 * 1024))
+# Processes decoding and re-encoding images, away from the event loop and the GIL
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", 2))
+# How far back an uncaptioned receipt looks for the expense it belongs to
+RECEIPT_LOOKBACK_MONTHS = 12
+
+DATE_RE = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+WORD_RE = re.compile(r"[^\W\d_][\w'-]*")
+
+os.makedirs(RECEIPTS_DIR, exist_ok=True)
+
+_executor = None
+_slots = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn, because forking a process that runs threads and an event loop isn't safe
+        _executor = ProcessPoolExecutor(max_workers=RECEIPT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+def _get_slots():
+    # Bounds images waiting on the pool, so a burst can't queue unbounded work or temp files
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(RECEIPT_WORKERS * 2)
+    return _slots
+
+def receipt_paths(digest):
+    folder = os.path.join(RECEIPTS_DIR, digest[:2])
+    return os.path.join(folder, f"{digest}.jpg"), os.path.join(folder, f"{digest}.thumb.jpg")
+
+def pick_photo_size(sizes):
+    # Smallest size that still covers RECEIPT_MAX_SIDE, so nothing is downloaded only to be thrown away
+    sizes = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in sizes:
+        if max(size.width, size.height) >= RECEIPT_MAX_SIDE:
+            return size
+    return sizes[-1]
+
+def process_image(source, image_path, thumb_path, max_side, thumb_side, quality):
+    # Runs in the receipt process pool
+    with Image.open(source) as original:
+        original.draft("RGB", (max_side, max_side))  # JPEGs decode straight at a reduced scale
+        img = ImageOps.exif_transpose(original).convert("RGB")
+    for path, side in ((image_path, max_side), (thumb_path, thumb_side)):
+        img.thumbnail((side, side))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        img.save(tmp_path, "JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, path)
+    return os.path.getsize(image_path) + os.path.getsize(thumb_path)
+
+async def download(file):
+    # Streams the file to a temp file while hashing it; returns (digest, temp path)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=RECEIPTS_DIR, prefix=".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            await downloads.stream_to(
+                file, out, RECEIPT_MAX_BYTES, f"Receipt is larger than {RECEIPT_MAX_BYTES} bytes", digest.update,
+            )
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return digest.hexdigest(), tmp_path
+
+async def store(file):
+    # Returns the receipt's digest; an image that was stored before is only downloaded
+    digest, tmp_path = await download(file)
+    image_path, thumb_path = receipt_paths(digest)
+    try:
+        if not os.path.exists(thumb_path):
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            async with _get_slots():
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    _get_executor(), process_image, tmp_path, image_path, thumb_path,
+                    RECEIPT_MAX_SIDE, RECEIPT_THUMB_SIDE, RECEIPT_QUALITY,
+                )
+    finally:
+        os.remove(tmp_path)
+    return digest
+
+def find_expense(user_id, caption=""):
+    # Latest expense on the caption's date and/or in its category; the latest overall without either
+    match = DATE_RE.search(caption)
+    words = WORD_RE.findall(DATE_RE.sub(" ", caption))
+    category = words[0].lower() if words else None
+    if match:
+        day = datetime.strptime(match.group(1), "%Y-%m-%d").date()
+        windows = [(day, day + timedelta(days=1))]
+    else:
+        # Month by month backwards, so a recent match never reads older history
+        windows = []
+        month = date.today().replace(day=1)
+        end = date.today() + timedelta(days=1)
+        for _ in range(RECEIPT_LOOKBACK_MONTHS):
+            windows.append((month, end))
+            end = month
+            month = (month - timedelta(days=1)).replace(day=1)
+    for start, end in windows:
+        expenses = storage.get_expenses(user_id, start.isoformat(), end.isoformat(), category)
+        if expenses:
+            return max(expenses, key=lambda e: e["date"])
+    return None
+
+def link(user_id, digest, caption=""):
+    # Attaches the receipt to the matching expense and returns it, or None if nothing matched
+    expense = find_expense(user_id, caption)
+    if expense is None or not storage.update_expense(user_id, expense, {"receipt": digest}):
+        return None
+    return expense
+
+async def close():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,249 @@
+import asyncio
+import calendar
+import heapq
+import json
+import os
+import re
+import threading
+import uuid
+from datetime import date, datetime, time, timedelta
+
+from . import alerts, parser, sharding, storage
+from .backends import atomic_write
+
+# Rules live encrypted in each user's profile under "recurring":
+#   {"id": "3f9c2a1b", "amount": 100.0, "category": "netflix",
+#    "schedule": {"every": "month", "day": 15}, "next_due": "2026-11-15"}
+# The due index only holds (next_due, user_id, rule id), so the daily job reads
+# just the users with something due instead of decrypting everyone.
+INDEX_FILE = os.path.join(
+    storage.DATA_DIR,
+    "recurring.json" if sharding.SHARD_COUNT == 1 else f"recurring.{sharding.SHARD_INDEX}.json",
+)
+# Occurrences posted per rule in one run when catching up after downtime; older ones are skipped
+RECURRING_MAX_CATCHUP = int(os.getenv("RECURRING_MAX_CATCHUP", 366))
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+DAILY_RE = re.compile(r"\b(?:daily|every\s+day)\b", re.I)
+WEEKLY_RE = re.compile(
+    r"\b(?:weekly|every\s+week)(?:\s+on)?(?:\s+(mon|tue|wed|thu|fri|sat|sun)[a-z]*)?\b", re.I
+)
+MONTHLY_RE = re.compile(
+    r"\b(?:monthly|every\s+month)(?:\s+on)?(?:\s+(?:the\s+|day\s+)?(\d{1,2})(?:st|nd|rd|th)?)?\b", re.I
+)
+
+# -------------------- SCHEDULES --------------------
+
+def _month_day(year, month, day):
+    # "Day 31" falls on the last day of shorter months
+    return date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+def first_due(schedule, start):
+    # First date on or after start that the schedule falls on
+    every = schedule["every"]
+    if every == "day":
+        return start
+    if every == "week":
+        return start + timedelta(days=(schedule["weekday"] - start.weekday()) % 7)
+    due = _month_day(start.year, start.month, schedule["day"])
+    if due < start:
+        year, month = (start.year + 1, 1) if start.month == 12 else (start.year, start.month + 1)
+        due = _month_day(year, month, schedule["day"])
+    return due
+
+def next_due(schedule, due):
+    return first_due(schedule, due + timedelta(days=1))
+
+def parse_rule(text, today=None):
+    # "Netflix 100", "gym 30 weekly on mon", "rent 800 monthly on the 1st", "coffee 3 daily".
+    # Without a schedule a rule repeats monthly on today's day of the month
+    today = today or date.today()
+    text = text or ""
+    schedule = {"every": "month", "day": today.day}
+    for regex in (DAILY_RE, WEEKLY_RE, MONTHLY_RE):
+        match = regex.search(text)
+        if not match:
+            continue
+        if regex is DAILY_RE:
+            schedule = {"every": "day"}
+        elif regex is WEEKLY_RE:
+            day = match.group(1)
+            schedule = {"every": "week", "weekday": WEEKDAYS.index(day.lower()) if day else today.weekday()}
+        else:
+            day = int(match.group(1)) if match.group(1) else today.day
+            if not 1 <= day <= 31:
+                return None
+            schedule = {"every": "month", "day": day}
+        text = text[:match.start()] + " " + text[match.end():]
+        break
+    expense = parser.parse_expense_message(text)
+    if not expense:
+        return None
+    expense.pop("date", None)
+    expense["id"] = uuid.uuid4().hex[:8]
+    expense["schedule"] = schedule
+    expense["next_due"] = first_due(schedule, today).isoformat()
+    return expense
+
+def describe(schedule):
+    if schedule["every"] == "day":
+        return "every day"
+    if schedule["every"] == "week":
+        return f"every {calendar.day_name[schedule['weekday']]}"
+    return f"monthly on day {schedule['day']}"
+
+# -------------------- DUE INDEX --------------------
+
+class DueIndex:
+    # Min-heap of (next_due, user_id, rule_id) persisted as JSON. Entries are never
+    # removed in place: a popped entry whose rule was deleted or already moved on is
+    # simply dropped when the user's profile is read.
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self._heap = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            entries = [tuple(entry) for entry in json.load(f)]
+        heapq.heapify(entries)
+        with self._lock:
+            self._heap = entries
+            self._dirty = False
+
+    def push(self, due, user_id, rule_id):
+        with self._lock:
+            heapq.heappush(self._heap, (str(due), str(user_id), rule_id))
+            self._dirty = True
+
+    def pop_due(self, today):
+        # {user_id: {rule_id, ...}} for everything due on or before today
+        due = {}
+        today = today.isoformat()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= today:
+                _, user_id, rule_id = heapq.heappop(self._heap)
+                due.setdefault(user_id, set()).add(rule_id)
+                self._dirty = True
+        return due
+
+    def __len__(self):
+        return len(self._heap)
+
+    def save(self, force=False):
+        # Writes are serialized and each one takes the latest snapshot, so an older
+        # snapshot can never land on top of a newer one
+        with self._write_lock:
+            with self._lock:
+                if not (self._dirty or force):
+                    return
+                entries = list(self._heap)
+                self._dirty = False
+            try:
+                atomic_write(self.path, json.dumps(entries).encode())
+            except Exception as e:
+                print(f"[ERROR] Failed to save the recurring index: {e}")
+                with self._lock:
+                    self._dirty = True
+
+index = DueIndex()
+_ready = False
+_ready_lock = None
+
+def _upgrade_rules(profile, today):
+    # Rules saved before schedules existed repeat monthly on the 1st, starting next month
+    changed = False
+    for rule in profile.get("recurring", []):
+        if "id" in rule and "next_due" in rule:
+            continue
+        rule.setdefault("id", uuid.uuid4().hex[:8])
+        rule.setdefault("schedule", {"every": "month", "day": 1})
+        rule["next_due"] = next_due(rule["schedule"], today).isoformat()
+        changed = True
+    return changed
+
+async def ensure_index():
+    # Loads the index, or builds it once by reading every profile when there is none yet
+    global _ready, _ready_lock
+    if _ready:
+        return
+    if _ready_lock is None:
+        _ready_lock = asyncio.Lock()
+    async with _ready_lock:
+        if _ready:
+            return
+        if index.exists():
+            await storage.run_blocking(index.load)
+            _ready = True
+            return
+        today = date.today()
+        for user_id in await storage.run_blocking(storage.list_user_ids):
+            async with storage.user_lock(user_id):
+                profile = await storage.aget_profile(user_id, months=())
+                if not profile or not profile.get("recurring"):
+                    continue
+                if _upgrade_rules(profile, today):
+                    await storage.asave_profile(user_id, profile)
+                for rule in profile["recurring"]:
+                    index.push(rule["next_due"], user_id, rule["id"])
+        # Written even when empty, so this scan happens only once
+        await storage.run_blocking(index.save, True)
+        _ready = True
+
+async def add_rule(user_id, rule):
+    await ensure_index()
+    async with storage.user_lock(user_id):
+        profile = await storage.aget_profile(user_id, months=()) or {}
+        profile.setdefault("recurring", []).append(rule)
+        await storage.asave_profile(user_id, profile)
+    index.push(rule["next_due"], user_id, rule["id"])
+    await storage.run_blocking(index.save)
+
+# -------------------- POSTING --------------------
+
+def _occurrence(rule, due):
+    expense = {k: v for k, v in rule.items() if k not in ("id", "schedule", "next_due")}
+    expense["date"] = datetime.combine(due, time()).isoformat()
+    expense["recurring"] = rule["id"]
+    return expense
+
+async def post_due_rules(user_id, rule_ids, today):
+    # Posts every occurrence of the given rules up to today in one storage write,
+    # moves each rule's next_due past today and re-indexes it. Returns the new
+    # expenses and any budget or limit alerts they set off
+    expenses, warnings = [], []
+    async with storage.user_lock(user_id):
+        profile = await storage.aget_profile(user_id, months=())
+        if not profile:
+            return expenses, warnings
+        advanced = []
+        for rule in profile.get("recurring", []):
+            if rule.get("id") not in rule_ids:
+                continue
+            due = date.fromisoformat(rule["next_due"])
+            if due > today:
+                continue  # Stale index entry; the rule's current one is still queued
+            posted = 0
+            while due <= today and posted < RECURRING_MAX_CATCHUP:
+                expenses.append(_occurrence(rule, due))
+                due = next_due(rule["schedule"], due)
+                posted += 1
+            if due <= today:
+                print(f"[WARNING] Skipped occurrences of recurring rule {rule['id']} for user {user_id} before {today}")
+                due = next_due(rule["schedule"], today)
+            rule["next_due"] = due.isoformat()
+            advanced.append(rule)
+        if not advanced:
+            return expenses, warnings
+        # Expenses first: a crash in between re-posts on restart rather than losing a charge
+        await storage.aappend_expenses(user_id, expenses)
+        await storage.asave_profile(user_id, profile)
+        warnings = await alerts.check(user_id, expenses)
+    for rule in advanced:
+        index.push(rule["next_due"], user_id, rule["id"])
+    return expenses, warnings
@@ -0,0 +1,67 @@
+from datetime import date, timedelta
+
+# Running totals kept on the user document so summaries never rescan the ledger:
+# {"2026-10": {"total": 120.5, "days": {"17": 20.0}, "categories": {"food": 80.0}}}
+
+def _add(totals, key, amount):
+    totals[key] = round(totals.get(key, 0) + amount, 2)
+
+def apply(rollups, expense, sign=1):
+    stamp = expense["date"]
+    month, day = stamp[:7], stamp[8:10]
+    amount = expense["amount"] * sign
+    bucket = rollups.setdefault(month, {"total": 0, "days": {}, "categories": {}})
+    bucket["total"] = round(bucket["total"] + amount, 2)
+    _add(bucket["days"], day, amount)
+    _add(bucket["categories"], expense.get("category", "misc"), amount)
+    return rollups
+
+def build(expenses):
+    rollups = {}
+    for e in expenses:
+        apply(rollups, e)
+    return rollups
+
+def day_total(rollups, day: date):
+    bucket = rollups.get(day.strftime("%Y-%m"), {})
+    return bucket.get("days", {}).get(day.strftime("%d"), 0)
+
+def range_total(rollups, start: date, end: date):
+    # Inclusive of both ends; costs one lookup per day in the range
+    total = 0
+    day = start
+    while day <= end:
+        total += day_total(rollups, day)
+        day += timedelta(days=1)
+    return round(total, 2)
+
+def month_total(rollups, month):
+    return rollups.get(month, {}).get("total", 0)
+
+def month_categories(rollups, month):
+    return dict(rollups.get(month, {}).get("categories", {}))
+
+def months_between(start: date, end: date):
+    # "YYYY-MM" keys of every month from start to end, both inclusive
+    months = []
+    month = start.replace(day=1)
+    while month <= end:
+        months.append(month.strftime("%Y-%m"))
+        month = (month + timedelta(days=32)).replace(day=1)
+    return months
+
+if __name__ == "__main__":
+    # Rebuild rollups for every stored user: python -m utils.rollups
+    from . import storage
+
+    count = 0
+    for user_id in storage.list_user_ids():
+        data = storage.get_user_data(user_id)
+        if data is None:
+            print(f"[WARNING] Skipping unreadable data for user {user_id}")
+            continue
+        data["rollups"] = build(data.get("expenses", []))
+        storage.save_user_data(user_id, data)
+        count += 1
+    storage.flush()
+    print(f"Rebuilt rollups for {count} users.")
@@ -1,82 +1,165 @@
-import schedule
-import threading
-import time
 import asyncio
 import os
-from datetime import datetime
-from . import storage, mailer
+import time
+from datetime import datetime, time as dtime, timedelta
+from . import storage, mailer, rollups, export, recurring
 from telegram import Bot
+from telegram.error import Forbidden, RetryAfter
+from telegram.ext import Application, ContextTypes
+
+# Users handled at once while fanning a job out over everyone
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 20))
+# Telegram allows roughly 30 messages per second across all chats
+SEND_RATE = float(os.getenv("SCHEDULER_SEND_RATE", 25))
+SEND_ATTEMPTS = 3
+
+LOCAL_TZ = datetime.now().astimezone().tzinfo
+DAILY_SUMMARY_TIME = dtime(20, 0, tzinfo=LOCAL_TZ)
+MONTHLY_REPORT_TIME = dtime(9, 0, tzinfo=LOCAL_TZ)
+RECURRING_TIME = dtime(0, 5, tzinfo=LOCAL_TZ)
+
+class RateLimiter:
+    # Spaces sends evenly so a 50k-user fan-out is a steady trickle, not a burst
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        # Telegram asked us to back off; hold every sender, not just the one that got flood-limited
+        self._next = max(self._next, time.monotonic() + seconds)
+
+_limiter = RateLimiter(SEND_RATE)
+
+async def send_message(bot: Bot, chat_id, text):
+    for _ in range(SEND_ATTEMPTS):
+        await _limiter.wait()
+        try:
+            return await bot.send_message(chat_id, text)
+        except RetryAfter as e:
+            _limiter.pause(float(e.retry_after))
+        except Forbidden:
+            # The user blocked the bot; nothing to retry
+            return None
+    print(f"[ERROR] Gave up sending to {chat_id} after {SEND_ATTEMPTS} flood-limited attempts")
+    return None
 
 # Daily summary
 async def send_daily_summary(bot: Bot, user_id, chat_id):
-    data = storage.get_user_data(user_id)
-    if not data:
-        return
-    today = datetime.now().date().isoformat()
-    summary = sum(e['amount'] for e in data.get('expenses', []) if e['date'].startswith(today))
-    await bot.send_message(chat_id, f"📊 Today's total: {summary:.2f}")
-
-# Category limit checks
-async def check_limits(bot: Bot, user_id, chat_id):
-    data = storage.get_user_data(user_id)
-    if not data:
-        return
-    limits = data.get("limits", {})
-    total = {}
-    for e in data.get("expenses", []):
-        cat = e['category']
-        total[cat] = total.get(cat, 0) + e['amount']
-    warnings = []
-    for cat, amt in total.items():
-        if cat in limits and amt > limits[cat]:
-            warnings.append(f"⚠️ {cat} overspent by {amt - limits[cat]:.2f}")
-    if warnings:
-        await bot.send_message(chat_id, "\n".join(warnings))
+    today = datetime.now().date()
+    last_expense = (storage.manifest_entry(user_id) or {}).get("last_expense")
+    if last_expense and last_expense < today.isoformat():
+        # Nothing dated today was written, so the total is known without reading the profile
+        summary = 0
+    else:
+        data = await storage.aget_profile(user_id, [today.strftime("%Y-%m")])
+        if not data:
+            return
+        summary = rollups.day_total(data.get("rollups", {}), today)
+    await send_message(bot, chat_id, f"📊 Today's total: {summary:.2f}")
 
 # Monthly email report
 async def send_monthly_report(bot: Bot, user_id, chat_id):
-    data = storage.get_user_data(user_id)
+    data = await storage.aget_profile(user_id, months=())
     if not data:
         return
     email = data.get("email")
     if email:
+        # Last calendar month
+        month_start = datetime.now().date().replace(day=1)
+        prev_start = (month_start - timedelta(days=1)).replace(day=1)
+        report, count, summary = await mailer.render_report(
+            user_id, prev_start.isoformat(), month_start.isoformat(), data.get("currency"),
+        )
+        if not count:
+            report.close()
+            return
+
+        async def notify():
+            await send_message(bot, chat_id, f"📧 Monthly report sent to {email}")
+
+        filename = export.export_filename(prev_start.isoformat(), month_start.isoformat())
+        # Waits only while the delivery queue is full; sending happens on the mailer's own workers
+        await mailer.mail_queue.submit(email, report, filename, on_sent=notify, summary=summary)
+
+# Fan a per-user job out over every stored user
+async def fan_out(bot: Bot, job, user_ids=None):
+    if user_ids is None:
+        user_ids = await storage.run_blocking(storage.list_user_ids)
+    pending = iter(user_ids)
+
+    async def worker():
+        # Workers share one iterator, so at most SCHEDULER_CONCURRENCY users are in flight
+        for user_id in pending:
+            try:
+                chat_id = int(user_id)
+            except ValueError:
+                print(f"Skipping user: {user_id} (not a user ID)")
+                continue
+            try:
+                await job(bot, user_id, chat_id)
+            except Exception as e:
+                print(f"[ERROR] {job.__name__} failed for {user_id}: {e}")
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(SCHEDULER_CONCURRENCY)))
+    print(f"[INFO] {job.__name__} finished in {time.monotonic() - started:.1f}s")
+
+async def _daily_summaries(context: ContextTypes.DEFAULT_TYPE):
+    await fan_out(context.bot, send_daily_summary)
+
+async def _monthly_reports(context: ContextTypes.DEFAULT_TYPE):
+    # Only users with an email on file, straight from the manifest
+    entries = await storage.run_blocking(storage.manifest_entries)
+    await fan_out(context.bot, send_monthly_report, [user_id for user_id, entry in entries.items() if entry.get("email")])
+    await mailer.mail_queue.join()
+
+async def _recurring_expenses(context: ContextTypes.DEFAULT_TYPE):
+    # Reads only the users with a rule due; anything missed while the bot was down is due too
+    await recurring.ensure_index()
+    today = datetime.now().date()
+    due = recurring.index.pop_due(today)
+    if not due:
+        return
+
+    async def post_recurring(bot: Bot, user_id, chat_id):
         try:
-            path = mailer.export_csv(user_id, data.get("expenses", []))
-            mailer.send_email(email, path)
-            await bot.send_message(chat_id, f"📧 Monthly report sent to {email}")
-        except Exception as e:
-            print(f"[ERROR] Failed to send report for {user_id}: {e}")
-
-# Main scheduler runner
-def run_schedule(bot: Bot):
-    user_files = [
-        f for f in os.listdir("data")
-        if f.endswith(".json") and f != "encrypted_data.json" and not f.startswith("keys/")
-    ]
-
-    for file in user_files:
-        user_id = file.replace(".json", "")
-        try:
-            chat_id = int(user_id)
-        except ValueError:
-            print(f"Skipping file: {file} (not a user ID)")
-            continue
+            expenses, warnings = await recurring.post_due_rules(user_id, due[user_id], today)
+        except Exception:
+            # Back in the index so the next run retries them
+            for rule_id in due[user_id]:
+                recurring.index.push(today, user_id, rule_id)
+            raise
+        if expenses:
+            lines = ["🔁 Recurring expenses added:"]
+            lines += [f"• {e['amount']} for {e['category']} on {e['date'][:10]}" for e in expenses]
+            await send_message(bot, chat_id, "\n".join(lines))
+        if warnings:
+            await send_message(bot, chat_id, "\n".join(warnings))
 
-        data = storage.get_user_data(user_id)
-        if not data:
-            continue  # Skip corrupted or unreadable files
-
-        schedule.every().day.at("20:00").do(lambda uid=user_id, cid=chat_id:
-            asyncio.run(send_daily_summary(bot, uid, cid)))
-        schedule.every().day.at("20:05").do(lambda uid=user_id, cid=chat_id:
-            asyncio.run(check_limits(bot, uid, cid)))
-        if datetime.now().day == 1:
-            asyncio.run(send_monthly_report(bot, user_id, chat_id))
-
-def run():
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
-
-def schedule_jobs(bot):
-    threading.Thread(target=run_schedule, args=(bot,), daemon=True).start()
+    await fan_out(context.bot, post_recurring, list(due))
+    await storage.run_blocking(recurring.index.save)
+
+def post_recurring_now(job_queue):
+    # Used when a rule that is already due gets saved
+    if job_queue is not None:
+        job_queue.run_once(_recurring_expenses, 0)
+
+def schedule_jobs(app: Application):
+    job_queue = app.job_queue
+    if job_queue is None:
+        print("[WARNING] JobQueue unavailable, install python-telegram-bot[job-queue] to enable scheduled jobs")
+        return
+    job_queue.run_daily(_daily_summaries, DAILY_SUMMARY_TIME, name="daily_summaries")
+    job_queue.run_monthly(_monthly_reports, MONTHLY_REPORT_TIME, day=1, name="monthly_reports")
+    job_queue.run_daily(_recurring_expenses, RECURRING_TIME, name="recurring_expenses")
+    # Catches up on rules that came due while the bot was down
+    job_queue.run_once(_recurring_expenses, 0, name="recurring_catch_up")
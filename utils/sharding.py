@@ -0,0 +1,27 @@
+import os
+import zlib
+
+# Set on each worker process started by webhook.py; a single process owns everyone
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+
+def shard_for(user_id, count=None):
+    # crc32 rather than hash() so every process agrees on the owner
+    count = count or SHARD_COUNT
+    return zlib.crc32(str(user_id).encode()) % count
+
+def owns(user_id):
+    return SHARD_COUNT == 1 or shard_for(user_id) == SHARD_INDEX
+
+def user_id_of(update):
+    # Sender of a raw Bot API update dict; chat id for senderless updates (channel posts)
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("voter_chat")
+        if sender:
+            return sender["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return update.get("update_id", 0)
@@ -1,14 +1,62 @@
-import json
+import asyncio
+import atexit
 import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from cryptography.fernet import Fernet
 
+from . import metrics, rollups, sharding
+from .manifest import UserManifest
+from .backends import (
+    EncryptedJsonBackend, PartitionedBackend, SqliteBackend, atomic_write, filter_expenses, same_expense,
+)
+
 DATA_DIR = "data"
 KEY_DIR = os.path.join(DATA_DIR, "keys")
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(KEY_DIR, exist_ok=True)
 
-def _get_file(user_id):
-    return os.path.join(DATA_DIR, f"{user_id}.json")
+# "partitioned" keeps an encrypted profile plus one encrypted segment per month for
+# each user, "json" one encrypted file per user, "sqlite" a single indexed database
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "partitioned")
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, "expenses.db"))
+
+# Small plain-JSON index of users for fleet-wide jobs (see utils/manifest.py); one per shard
+MANIFEST_PATH = os.path.join(
+    DATA_DIR, "manifest.json" if sharding.SHARD_COUNT == 1 else f"manifest.{sharding.SHARD_INDEX}.json",
+)
+
+# Journal files are folded into the snapshot once they grow past this size
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", 64 * 1024))
+
+# Decrypted user documents (profiles and recent months' rollups on indexed backends)
+# and Fernet instances kept in memory
+CACHE_SIZE = int(os.getenv("STORAGE_CACHE_SIZE", 1024))
+FERNET_CACHE_SIZE = int(os.getenv("STORAGE_FERNET_CACHE_SIZE", 4096))
+# Seconds between write-behind flushes of dirty documents
+FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", 5))
+# Threads used by the async API for disk I/O and Fernet/JSON work
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", 4))
+
+_lock = threading.RLock()
+_cache = OrderedDict()  # user_id -> {"data": dict, "dirty": bool}; indexed backends cache profiles only
+# Indexed backends also keep the rollup buckets of recently read months, so summaries
+# and alerts don't decrypt the month's segment every time:
+# user_id -> {"months": {"YYYY-MM": bucket or None}, "complete": bool}
+_rollup_cache = OrderedDict()
+_fernets = OrderedDict()  # user_id -> Fernet
+_evicted = {}  # user_id -> dirty data evicted from the cache but not yet written
+_io_locks = {}  # user_id -> threading.Lock
+_user_locks = weakref.WeakValueDictionary()  # user_id -> asyncio.Lock
+_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+_flusher = None
+_stop_flusher = threading.Event()
+
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "flushes": 0}
 
 def _get_key_file(user_id):
     return os.path.join(KEY_DIR, f"{user_id}.key")
@@ -19,48 +67,465 @@ def _load_or_generate_key(user_id):
         with open(key_path, "rb") as f:
             return f.read()
     key = Fernet.generate_key()
-    with open(key_path, "wb") as f:
-        f.write(key)
+    atomic_write(key_path, key)
     return key
 
 def _get_fernet(user_id):
-    return Fernet(_load_or_generate_key(user_id))
+    with _lock:
+        fernet = _fernets.get(user_id)
+        if fernet is not None:
+            _fernets.move_to_end(user_id)
+            return fernet
+        fernet = Fernet(_load_or_generate_key(user_id))
+        _fernets[user_id] = fernet
+        if len(_fernets) > FERNET_CACHE_SIZE:
+            _fernets.popitem(last=False)
+        return fernet
+
+def create_backend(kind=None, sqlite_path=None):
+    kind = kind or STORAGE_BACKEND
+    if kind == "sqlite":
+        return SqliteBackend(sqlite_path or SQLITE_PATH, _get_fernet)
+    if kind == "partitioned":
+        return PartitionedBackend(DATA_DIR, _get_fernet, JOURNAL_COMPACT_BYTES)
+    if kind == "json":
+        return EncryptedJsonBackend(DATA_DIR, _get_fernet, JOURNAL_COMPACT_BYTES)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+_backend = create_backend()
+_manifest = UserManifest(MANIFEST_PATH)
+
+# -------------------- CACHE --------------------
+
+def _io_lock(user_id):
+    # Serializes disk access per user; the global lock only guards the cache itself
+    with _lock:
+        lock = _io_locks.get(user_id)
+        if lock is None:
+            lock = _io_locks[user_id] = threading.Lock()
+        return lock
+
+def _cache_lookup(user_id):
+    entry = _cache.get(user_id)
+    if entry is None:
+        pending = _evicted.pop(user_id, None)
+        if pending is None:
+            return None
+        # Evicted but not written yet: take it back instead of reading stale disk data
+        entry = _cache[user_id] = {"data": pending, "dirty": True}
+    cache_stats["hits"] += 1
+    _cache.move_to_end(user_id)
+    return entry
+
+def _cache_put(user_id, data, dirty):
+    _evicted.pop(user_id, None)
+    _cache[user_id] = {"data": data, "dirty": dirty}
+    _cache.move_to_end(user_id)
+    evicted = []
+    while len(_cache) > CACHE_SIZE:
+        evicted_id, entry = _cache.popitem(last=False)
+        cache_stats["evictions"] += 1
+        if entry["dirty"]:
+            _evicted[evicted_id] = entry["data"]
+            evicted.append(evicted_id)
+    return evicted
+
+def _copy_bucket(bucket):
+    # Callers get their own copy, so nothing they change leaks into the cache
+    return {"total": bucket["total"], "days": dict(bucket["days"]), "categories": dict(bucket["categories"])}
+
+def _cached_rollups(user_id, months):
+    # Rollups for months (all of them when None) from the cache, or None on a miss
+    entry = _rollup_cache.get(user_id)
+    if entry is None:
+        return None
+    if months is None and not entry["complete"]:
+        return None
+    if months is not None and not entry["complete"] and any(m not in entry["months"] for m in months):
+        return None
+    _rollup_cache.move_to_end(user_id)
+    cache_stats["hits"] += 1
+    wanted = entry["months"] if months is None else months
+    return {m: _copy_bucket(entry["months"][m]) for m in wanted if entry["months"].get(m) is not None}
+
+def _cache_rollups(user_id, months, totals):
+    entry = _rollup_cache.get(user_id)
+    if entry is None:
+        entry = _rollup_cache[user_id] = {"months": {}, "complete": False}
+    _rollup_cache.move_to_end(user_id)
+    if months is None:
+        entry["months"] = {m: _copy_bucket(bucket) for m, bucket in totals.items()}
+        entry["complete"] = True
+    else:
+        for m in months:
+            bucket = totals.get(m)
+            entry["months"][m] = _copy_bucket(bucket) if bucket is not None else None
+    while len(_rollup_cache) > CACHE_SIZE:
+        _rollup_cache.popitem(last=False)
+
+def _forget_rollups(user_id, months=None):
+    # Drops the given months (all of them when None) after a write changes them
+    if months is None:
+        _rollup_cache.pop(user_id, None)
+        return
+    entry = _rollup_cache.get(user_id)
+    if entry is not None:
+        for m in months:
+            entry["months"].pop(m, None)
+        entry["complete"] = False
+
+def _load_rollups(user_id, months):
+    with _lock:
+        totals = _cached_rollups(user_id, months)
+    if totals is not None:
+        return totals
+    with _io_lock(user_id):
+        with _lock:
+            totals = _cached_rollups(user_id, months)
+            if totals is not None:
+                return totals
+            cache_stats["misses"] += 1
+        totals = _backend.load_rollups(user_id, months)
+        with _lock:
+            _cache_rollups(user_id, months, totals)
+    return totals
+
+def _write(user_id, data):
+    if _backend.indexed:
+        return _backend.save_profile(user_id, data)
+    return _backend.save(user_id, data)
+
+def _write_evicted(user_ids):
+    for user_id in user_ids:
+        with _io_lock(user_id):
+            with _lock:
+                data = _evicted.get(user_id)
+            if data is None:
+                continue
+            ok = _write(user_id, data)
+            with _lock:
+                if ok and _evicted.get(user_id) is data:
+                    del _evicted[user_id]
+
+@metrics.timed("storage")
+def flush():
+    with _lock:
+        dirty = [uid for uid, entry in _cache.items() if entry["dirty"]]
+        evicted = list(_evicted)
+    for user_id in dirty:
+        with _io_lock(user_id):
+            with _lock:
+                entry = _cache.get(user_id)
+                if entry is None or not entry["dirty"]:
+                    continue
+                # Cleared before writing so a save during the write marks it dirty again
+                entry["dirty"] = False
+            if _write(user_id, entry["data"]):
+                cache_stats["flushes"] += 1
+            else:
+                entry["dirty"] = True
+    _write_evicted(evicted)
+    if _manifest.loaded():
+        _manifest.flush()
+
+def _rebuild_manifest():
+    # Reads every owned user's profile once; only runs when there is no manifest on disk
+    entries = {}
+    for user_id in _backend.list_users():
+        if not sharding.owns(user_id):
+            continue
+        profile = (_backend.load_profile(user_id) if _backend.indexed else _backend.load(user_id)) or {}
+        entries[user_id] = {
+            "chat_id": int(user_id),
+            "timezone": profile.get("timezone"),
+            "email": bool(profile.get("email")),
+            "active": None,
+            "last_expense": None,  # Unknown until the next write
+            "version": 0,
+        }
+    return entries
+
+def load_manifest():
+    # Call at startup so the first handler never pays for loading (or building) it
+    _manifest.load(_rebuild_manifest)
+
+def _note_profile(user_id, profile):
+    load_manifest()
+    _manifest.update(user_id, timezone=profile.get("timezone"), email=bool(profile.get("email")))
+
+def _note_expenses(user_id, expenses):
+    load_manifest()
+    fields = {"active": datetime.now().isoformat(timespec="seconds")}
+    if expenses:
+        latest = max(e["date"] for e in expenses)[:10]
+        previous = (_manifest.get(user_id) or {}).get("last_expense")
+        fields["last_expense"] = max(latest, previous) if previous else latest
+    _manifest.update(user_id, increment="version", **fields)
+
+def clear_cache():
+    # Write everything back and start cold; used by the benchmarks
+    flush()
+    with _lock:
+        _cache.clear()
+        _rollup_cache.clear()
+        _fernets.clear()
+
+def _flush_loop():
+    while not _stop_flusher.wait(FLUSH_INTERVAL):
+        flush()
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None or not _flusher.is_alive():
+        _stop_flusher.clear()
+        _flusher = threading.Thread(target=_flush_loop, name="storage-flush", daemon=True)
+        _flusher.start()
 
+def shutdown():
+    _stop_flusher.set()
+    flush()
+    _executor.shutdown(wait=True)
+    _backend.close()
+
+atexit.register(shutdown)
+
+# -------------------- PUBLIC API --------------------
+
+@metrics.timed("storage")
 def get_user_data(user_id):
+    # The whole document, expenses included. Indexed backends read it fresh every
+    # time; prefer get_profile / iter_expenses there
     if user_id == "encrypted_data":
         print("Skipping system file: encrypted_data.json")
         return None
 
-    path = _get_file(user_id)
-    if not os.path.exists(path):
-        return None
+    user_id = str(user_id)
+    if _backend.indexed:
+        profile = _load_profile(user_id)
+        if profile is None:
+            return None
+        data = dict(profile)
+        data["rollups"] = _load_rollups(user_id, None)
+        with _io_lock(user_id):
+            data["expenses"] = list(_backend.iter_expenses(user_id))
+        return data
 
-    fernet = _get_fernet(user_id)
-    with open(path, "rb") as f:
-        try:
-            decrypted = fernet.decrypt(f.read()).decode()
-            return json.loads(decrypted)
-        except Exception as e:
-            print(f"[ERROR] Failed to decrypt data for user {user_id}: {e}")
-            return None  # Optionally: os.remove(path) to reset corrupted files
+    with _lock:
+        entry = _cache_lookup(user_id)
+        if entry is not None:
+            return entry["data"]
+    evicted = []
+    with _io_lock(user_id):
+        with _lock:
+            # Another thread may have loaded it while we waited
+            entry = _cache_lookup(user_id)
+            if entry is not None:
+                return entry["data"]
+            cache_stats["misses"] += 1
+        data = _backend.load(user_id)
+        if data is not None:
+            with _lock:
+                evicted = _cache_put(user_id, data, dirty=False)
+    _write_evicted(evicted)
+    return data
 
+@metrics.timed("storage")
 def save_user_data(user_id, data):
-    path = _get_file(user_id)
-    fernet = _get_fernet(user_id)
-    try:
-        encrypted = fernet.encrypt(json.dumps(data).encode())
-        with open(path, "wb") as f:
-            f.write(encrypted)
-    except Exception as e:
-        print(f"[ERROR] Failed to save data for user {user_id}: {e}")
-
-def set_user_pin(user_id, pin):
-    data = get_user_data(user_id) or {}
-    data["pin"] = pin
-    save_user_data(user_id, data)
-
-def validate_user_pin(user_id, pin):
+    user_id = str(user_id)
+    if "rollups" not in data:
+        data["rollups"] = rollups.build(data.get("expenses", []))
+    _note_profile(user_id, data)
+    _note_expenses(user_id, data.get("expenses", []))
+    if _backend.indexed:
+        # Whole-ledger rewrites are rare (rebuilds, imports), so they skip the write-behind cache
+        profile = {k: v for k, v in data.items() if k not in ("expenses", "rollups")}
+        with _io_lock(user_id):
+            ok = _backend.save(user_id, data)
+            with _lock:
+                _forget_rollups(user_id)
+                if not ok:
+                    return
+                evicted = _cache_put(user_id, profile, dirty=False)
+        _write_evicted(evicted)
+        return
+    with _lock:
+        evicted = _cache_put(user_id, data, dirty=True)
+    _write_evicted(evicted)
+    _ensure_flusher()
+
+@metrics.timed("storage")
+def append_expenses(user_id, expenses):
+    if not expenses:
+        return
+    user_id = str(user_id)
+    with _io_lock(user_id):
+        ok = _backend.append_expenses(user_id, expenses)
+        if _backend.indexed:
+            # Only profiles and rollups are cached; the months written to are read again
+            with _lock:
+                _forget_rollups(user_id, {e["date"][:7] for e in expenses})
+        if not ok:
+            return
+        _note_expenses(user_id, expenses)
+        if _backend.indexed:
+            return
+        with _lock:
+            # The backend already holds the new rows, so a cached copy stays clean
+            entry = _cache_lookup(user_id)
+            if entry is not None:
+                data = entry["data"]
+                data.setdefault("expenses", []).extend(expenses)
+                totals = data.setdefault("rollups", {})
+                for e in expenses:
+                    rollups.apply(totals, e)
+
+def append_expense(user_id, expense):
+    append_expenses(user_id, [expense])
+
+def _load_profile(user_id):
+    with _lock:
+        entry = _cache_lookup(user_id)
+        if entry is not None:
+            return entry["data"]
+    evicted = []
+    with _io_lock(user_id):
+        with _lock:
+            entry = _cache_lookup(user_id)
+            if entry is not None:
+                return entry["data"]
+            cache_stats["misses"] += 1
+        profile = _backend.load_profile(user_id)
+        if profile is not None:
+            with _lock:
+                evicted = _cache_put(user_id, profile, dirty=False)
+    _write_evicted(evicted)
+    return profile
+
+@metrics.timed("storage")
+def get_profile(user_id, months=None):
+    # Settings plus rollups for the given "YYYY-MM" months (all months when None).
+    # On indexed backends only those months are read; pass () to skip rollups entirely
+    if not _backend.indexed:
+        return get_user_data(user_id)
+    user_id = str(user_id)
+    profile = _load_profile(user_id)
+    if profile is None:
+        return None
+    profile = dict(profile)
+    if months is None or months:
+        profile["rollups"] = _load_rollups(user_id, months)
+    else:
+        profile["rollups"] = {}
+    return profile
+
+@metrics.timed("storage")
+def save_profile(user_id, profile):
+    # Writes settings only; expenses and rollups in the dict are ignored
+    user_id = str(user_id)
+    _note_profile(user_id, profile)
+    if not _backend.indexed:
+        data = get_user_data(user_id) or {"expenses": []}
+        if data is not profile:
+            data.update({k: v for k, v in profile.items() if k not in ("expenses", "rollups")})
+        save_user_data(user_id, data)
+        return
+    profile = {k: v for k, v in profile.items() if k not in ("expenses", "rollups")}
+    with _lock:
+        evicted = _cache_put(user_id, profile, dirty=True)
+    _write_evicted(evicted)
+    _ensure_flusher()
+
+@metrics.timed("storage")
+def update_expense(user_id, expense, changes):
+    # Merges changes (e.g. {"receipt": ...}) into the stored expense with expense's
+    # date, amount and category. Returns whether one was found
+    user_id = str(user_id)
+    _note_expenses(user_id, [])
+    if _backend.indexed:
+        with _io_lock(user_id):
+            try:
+                return _backend.update_expense(user_id, expense, changes)
+            finally:
+                with _lock:
+                    _forget_rollups(user_id)  # changes may move or re-price it
     data = get_user_data(user_id)
-    if data is None:
-        return False
-    return data.get("pin") == pin
+    for e in reversed((data or {}).get("expenses", [])):
+        if same_expense(e, expense):
+            e.update(changes)
+            save_user_data(user_id, data)
+            return True
+    return False
+
+def iter_expenses(user_id, start=None, end=None, category=None):
+    # start is inclusive and end exclusive, both ISO date or datetime strings.
+    # Indexed backends read only the rows (or months) in range
+    user_id = str(user_id)
+    if _backend.indexed:
+        with _io_lock(user_id):
+            yield from _backend.iter_expenses(user_id, start, end, category)
+        return
+    expenses = (get_user_data(user_id) or {}).get("expenses", [])
+    yield from filter_expenses(expenses, start, end, category)
+
+@metrics.timed("storage")
+def get_expenses(user_id, start=None, end=None, category=None):
+    return list(iter_expenses(user_id, start, end, category))
+
+def list_user_ids():
+    # From the manifest, so no user files are listed or read. Only the users
+    # this worker owns when running sharded (webhook.py)
+    load_manifest()
+    return list(_manifest.entries())
+
+def manifest_entries():
+    # {user_id: {"chat_id", "timezone", "email", "active", "last_expense", "version"}}
+    load_manifest()
+    return _manifest.entries()
+
+def manifest_entry(user_id):
+    load_manifest()
+    return _manifest.get(user_id)
+
+# -------------------- ASYNC API --------------------
+
+def user_lock(user_id):
+    # Hold across a read-modify-write so overlapping updates from one user can't lose changes
+    user_id = str(user_id)
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+async def run_blocking(func, *args):
+    # Disk I/O and Fernet/JSON work run on the storage pool, never on the event loop
+    loop = asyncio.get_running_loop()
+    queued = time.perf_counter()
+
+    def call():
+        # Time spent waiting for a free worker shows when the pool is too small
+        metrics.observe_latency("storage_queue_wait_seconds", func.__name__, time.perf_counter() - queued)
+        return func(*args)
+
+    return await loop.run_in_executor(_executor, call)
+
+async def aget_user_data(user_id):
+    return await run_blocking(get_user_data, user_id)
+
+async def asave_user_data(user_id, data):
+    return await run_blocking(save_user_data, user_id, data)
+
+async def aappend_expenses(user_id, expenses):
+    return await run_blocking(append_expenses, user_id, expenses)
+
+async def aappend_expense(user_id, expense):
+    return await run_blocking(append_expense, user_id, expense)
+
+async def aget_profile(user_id, months=None):
+    return await run_blocking(get_profile, user_id, months)
+
+async def asave_profile(user_id, profile):
+    return await run_blocking(save_profile, user_id, profile)
+
+async def aget_expenses(user_id, start=None, end=None, category=None):
+    return await run_blocking(get_expenses, user_id, start, end, category)
+
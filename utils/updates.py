@@ -0,0 +1,40 @@
+import asyncio
+import weakref
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different users run side by side, but each user's updates run
+    # one at a time in arrival order, so their ConversationHandler state (which
+    # PTB doesn't guard against concurrent updates) only ever sees one at a time.
+    # A user with a burst of updates waiting holds at most that many of the
+    # max_concurrent_updates slots.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = weakref.WeakValueDictionary()  # user or chat id -> asyncio.Lock
+
+    def _lock_for(self, update):
+        if not isinstance(update, Update):
+            return None
+        owner = update.effective_user or update.effective_chat
+        if owner is None:
+            return None
+        lock = self._locks.get(owner.id)
+        if lock is None:
+            lock = self._locks[owner.id] = asyncio.Lock()
+        return lock
+
+    async def do_process_update(self, update, coroutine):
+        lock = self._lock_for(update)
+        if lock is None:
+            await coroutine
+            return
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
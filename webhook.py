@@ -0,0 +1,224 @@
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import signal
+from dotenv import load_dotenv
+
+from utils import sharding
+
+# Webhook deployment: this process receives Telegram's webhook calls and routes each
+# update by user to one of SHARD_WORKERS bot processes. Every worker runs the full
+# bot (handlers, caches, scheduler) for its own users only, so nothing is shared or
+# locked across processes.
+#   WEBHOOK_URL=https://example.com/webhook WEBHOOK_SECRET=... python webhook.py
+# For a local run against bench/feeder.py see the notes at the top of that file.
+
+load_dotenv()
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Registered with Telegram on startup; leave unset to manage the webhook yourself
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Telegram sends this back in X-Telegram-Bot-Api-Secret-Token on every call
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", os.cpu_count() or 1))
+# Updates waiting per worker; past this the receiver answers 503 and Telegram retries later
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000))
+MAX_BODY_BYTES = 1024 * 1024
+WATCHDOG_INTERVAL = 5
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               413: "Payload Too Large", 503: "Service Unavailable"}
+
+# -------------------- WORKERS --------------------
+
+@contextlib.contextmanager
+def shard_env(index, count):
+    # Spawned children re-import this module (as __mp_main__), and with it
+    # utils.sharding, before run_worker is even called. Shard settings are read at
+    # import time, so they have to reach the child through the environment it
+    # inherits at start(), not be set once it's running
+    saved = {name: os.environ.get(name) for name in ("SHARD_INDEX", "SHARD_COUNT", "METRICS_PORT")}
+    os.environ["SHARD_INDEX"] = str(index)
+    os.environ["SHARD_COUNT"] = str(count)
+    metrics_port = int(saved["METRICS_PORT"] or 0)
+    if metrics_port:
+        os.environ["METRICS_PORT"] = str(metrics_port + index)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def run_worker(index, count, updates):
+    if (sharding.SHARD_INDEX, sharding.SHARD_COUNT) != (index, count):
+        raise RuntimeError(f"Worker {index} started as shard {sharding.SHARD_INDEX} of {sharding.SHARD_COUNT}")
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The receiver decides when workers stop
+
+    import main
+    asyncio.run(_serve_updates(main.build_application(), updates))
+
+async def _serve_updates(app, updates):
+    from telegram import Update
+
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        while True:
+            batch = [await loop.run_in_executor(None, updates.get)]
+            # Drain whatever else is waiting without another thread hop per update
+            try:
+                while len(batch) < 100:
+                    batch.append(updates.get_nowait())
+            except queue.Empty:
+                pass
+            for payload in batch:
+                if payload is None:
+                    return
+                await app.update_queue.put(Update.de_json(json.loads(payload), app.bot))
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+class WorkerPool:
+    def __init__(self, count, queue_size=SHARD_QUEUE_SIZE):
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(queue_size) for _ in range(count)]
+        self.processes = [None] * count
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=run_worker, args=(index, len(self.queues), self.queues[index]), name=f"shard-{index}"
+        )
+        with shard_env(index, len(self.queues)):
+            process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+
+    def revive(self):
+        # A dead worker would leave its users unanswered; its queue is kept, so nothing queued is lost
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                print(f"[ERROR] Worker {index} exited with code {process.exitcode}, restarting")
+                self._spawn(index)
+
+    def stop(self):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
+
+# -------------------- RECEIVER --------------------
+
+class Receiver:
+    def __init__(self, queues):
+        self.queues = queues
+
+    def route(self, body):
+        update = json.loads(body)
+        shard = sharding.shard_for(sharding.user_id_of(update), len(self.queues))
+        try:
+            # Workers parse the raw body again, which is cheaper than pickling the dict
+            self.queues[shard].put_nowait(body)
+        except queue.Full:
+            return False
+        return True
+
+    def dispatch(self, method, path, headers, body):
+        if method != "POST" or path != WEBHOOK_PATH:
+            return 404
+        if WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403
+        try:
+            return 200 if self.route(body) else 503
+        except (ValueError, AttributeError, KeyError, TypeError):
+            return 400
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive; Telegram only ever POSTs small JSON bodies
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    status, keep_alive = 413, False
+                else:
+                    body = await reader.readexactly(length)
+                    status = self.dispatch(method, path, headers, body)
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.CancelledError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def register_webhook():
+    from telegram import Bot
+
+    api_url = os.getenv("TELEGRAM_API_URL")
+    kwargs = {"base_url": f"{api_url}/bot"} if api_url else {}
+    async with Bot(os.getenv("BOT_TOKEN"), **kwargs) as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=100)
+    print(f"[INFO] Webhook registered at {WEBHOOK_URL}")
+
+async def serve(pool):
+    server = await asyncio.start_server(Receiver(pool.queues).handle, WEBHOOK_HOST, WEBHOOK_PORT)
+    if WEBHOOK_URL:
+        await register_webhook()
+    print(f"[INFO] Routing {WEBHOOK_PATH} on {WEBHOOK_HOST}:{WEBHOOK_PORT} to {len(pool.queues)} workers")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=WATCHDOG_INTERVAL)
+            except asyncio.TimeoutError:
+                pool.revive()
+
+def main():
+    pool = WorkerPool(SHARD_WORKERS)
+    pool.start()
+    try:
+        asyncio.run(serve(pool))
+    finally:
+        # Workers finish what's queued, flush their storage and exit; a second Ctrl-C mustn't cut that short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pool.stop()
+
+if __name__ == "__main__":
+    main()